@@ -13,8 +13,15 @@ import i24_logger.log_writer as log_writer
 import time
 import ijson
 import sys
+import re
+import json
+import heapq
+import numpy as np
+from multiprocessing import Pool
 
 import utils.misc as misc
+from utils.utils_store import FragmentStore, store_path
+from utils.utils_transport import batched_writer
 
 verbs = ["medicates", "taunts", "sweettalks", "initiates", "harasses", "negotiates", "castigates", "disputes", "cajoles", "improvises",
          "surrenders", "escalates", "mumbles", "juxtaposes", "excites", "lionizes", "ruptures", "yawns","administers","flatters","foreshadows","buckles",
@@ -28,9 +35,214 @@ def thread_update_one(raw, _id, filter, fitx, fity):
                                             "fitx": list(fitx),
                                             "fity": list(fity)}}, upsert = True)
     
+def _as_list(val):
+    return val if isinstance(val, (list, tuple)) else [val]
+
+
+def fragment_filter(query_filter):
+    """
+    Build a predicate on a raw (not yet converted) document from query_filter. Keys are all optional:
+        start_time, end_time: keep fragments that overlap [start_time, end_time]
+        direction: 1, -1 or a list of them
+        compute_node_id: compute_node_id as in the raw data, or a list of them
+        min_length: minimum number of samples
+        min_conf: drop fragments with less than 4 samples of detection_confidence >= min_conf, same as merge_resample
+    :return: None if there is nothing to filter
+    """
+    if not query_filter:
+        return None
+    
+    start_time = query_filter.get("start_time")
+    end_time = query_filter.get("end_time")
+    directions = _as_list(query_filter["direction"]) if "direction" in query_filter else None
+    nodes = _as_list(query_filter["compute_node_id"]) if "compute_node_id" in query_filter else None
+    min_length = query_filter.get("min_length")
+    min_conf = query_filter.get("min_conf")
+    
+    def keep(doc):
+        if start_time is not None and doc["last_timestamp"] < start_time:
+            return False
+        if end_time is not None and doc["first_timestamp"] > end_time:
+            return False
+        if directions is not None and doc["direction"] not in directions:
+            return False
+        if nodes is not None and doc.get("compute_node_id") not in nodes:
+            return False
+        if min_length is not None and len(doc["timestamp"]) < min_length:
+            return False
+        if min_conf is not None:
+            nl = min(len(doc["detection_confidence"]), len(doc["timestamp"]))
+            if sum(1 for c in doc["detection_confidence"][:nl] if c >= min_conf) < 4:
+                return False
+        return True
+    
+    return keep
+    
+
+_JSON_TOKEN = re.compile(rb'[{}\[\]"\\]')
+
+def find_element_offsets(filename, chunk_size=1<<24):
+    """
+    Byte ranges [start, end) of every top-level element of a json array file
+    Only brackets, quotes and escapes are looked at (numbers are skipped by the regex), so this is much cheaper than parsing
+    """
+    offsets = []
+    depth = 0
+    in_string = False
+    skip = -1 # absolute position of an escaped character
+    start = None
+    base = 0
+    
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            for m in _JSON_TOKEN.finditer(chunk):
+                p = base + m.start()
+                if p == skip:
+                    continue
+                c = m.group()
+                if in_string:
+                    if c == b'\\':
+                        skip = p+1
+                    elif c == b'"':
+                        in_string = False
+                elif c == b'"':
+                    in_string = True
+                elif c in (b'{', b'['):
+                    depth += 1
+                    if depth == 2:
+                        start = p
+                elif c in (b'}', b']'):
+                    if depth == 2:
+                        offsets.append((start, p+1))
+                    depth -= 1
+            base += len(chunk)
+            
+    return offsets
+
+
+def split_byte_ranges(offsets, n_ranges):
+    """
+    Group consecutive elements into at most n_ranges byte ranges of similar size
+    """
+    if not offsets:
+        return []
+    total = offsets[-1][1] - offsets[0][0]
+    target = max(1, total // n_ranges)
+    ranges = []
+    range_start = offsets[0][0]
+    for i, (_, end) in enumerate(offsets):
+        if end - range_start >= target or i == len(offsets)-1:
+            ranges.append((range_start, end))
+            if i < len(offsets)-1:
+                range_start = offsets[i+1][0]
+    return ranges
+
+
+def _parse_byte_range(args):
+    """
+    Worker: parse one byte range of top-level elements, filter, convert, and sort by last_timestamp
+    time series are returned as numpy arrays to keep the result compact
+    """
+    filename, start, end, query_filter = args
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        data = f.read(end-start)
+    keep = fragment_filter(query_filter)
+    docs = []
+    discard, filtered = 0, 0
+    for doc in json.loads(b"[" + data + b"]"):
+        if keep is not None and not keep(doc):
+            filtered += 1
+        elif len(doc["timestamp"]) > 3:
+            doc = misc.prepare_raw_doc(doc)
+            if doc is None:
+                discard += 1
+                continue
+            for key in misc.RAW_TIME_SERIES_FIELDS:
+                doc[key] = np.array(doc[key])
+            docs.append(doc)
+        else:
+            discard += 1
+    docs.sort(key=lambda doc: doc["last_timestamp"])
+    return docs, discard, filtered
+
+
+def read_fragments_parallel(default_param, logger, query_filter=None):
+    """
+    Parallel ingest of <raw_collection>.json: the file is split into byte ranges aligned on top-level array elements,
+    each range is parsed in a worker process, and the results are merged back in last_timestamp order
+    All parsed fragments are held in memory until the merge is done. Use raw_format "store" for dumps that do not fit
+    """
+    filename = default_param["raw_collection"]+'.json'
+    n_proc = default_param["reader_workers"]
+    t1 = time.time()
+    offsets = find_element_offsets(filename)
+    ranges = split_byte_ranges(offsets, 4*n_proc)
+    logger.info("starts reading {} fragments from {} in {} byte ranges with {} workers. Scan took {:.2f} sec".format(len(offsets), filename, 
+                                                                                                          len(ranges), n_proc, time.time()-t1))
+    
+    with Pool(processes=n_proc) as pool:
+        results = pool.map(_parse_byte_range, [(filename, start, end, query_filter) for start, end in ranges])
+        
+    logger.debug("Discarded {} short tracks".format(sum(res[1] for res in results)))
+    logger.info("Filtered out {} fragments by query filter {}".format(sum(res[2] for res in results), query_filter))
+    
+    for doc in heapq.merge(*[res[0] for res in results], key=lambda doc: doc["last_timestamp"]):
+        yield doc
+        
+        
+def read_fragments(default_param, logger, query_filter=None):
+    """
+    Generator of ready-to-use fragments from <raw_collection>.json or from its columnar store, in file order
+    tracks shorter than 4 samples are discarded
+    query_filter (see fragment_filter) is applied before any conversion. On the store it is evaluated on the index,
+    so the fragments that are filtered out are never read
+    """
+    if default_param["raw_format"] == "store":
+        # fragments are already converted and interpolated (see utils/utils_store.py)
+        path = store_path(default_param["raw_collection"])
+        logger.info("starts reading from {}".format(path))
+        store = FragmentStore(path)
+        selected = store.select(query_filter)
+        logger.info("{} of {} fragments selected by query filter {}".format(len(selected), len(store), query_filter))
+        for i in selected:
+            yield store[i]
+        return
+    
+    if default_param["reader_workers"] > 1:
+        yield from read_fragments_parallel(default_param, logger, query_filter)
+        return
+    
+    logger.info("starts reading from {}.json".format(default_param["raw_collection"]))
+    discard = 0 # counter for short (<3) tracks
+    filtered = 0
+    keep = fragment_filter(query_filter)
+    
+    with open(default_param["raw_collection"]+'.json', 'rb') as f:
+        for doc in ijson.items(f, 'item'):
+            if keep is not None and not keep(doc):
+                filtered += 1
+            elif len(doc["timestamp"]) > 3: 
+                # convert time series from decimal to float, interpolate nans
+                doc = misc.prepare_raw_doc(doc)
+                if doc is not None:
+                    yield doc
+                else:
+                    discard += 1
+            else:
+                print("****** discard ",doc["_id"])
+                discard += 1
+                
+    logger.debug("Discarded {} short tracks".format(discard))
+    logger.info("Filtered out {} fragments by query filter {}".format(filtered, query_filter))
+    
+    
 def static_data_reader(default_param, db_param, raw_queue, query_filter, name=None):
     """
-    Read data from a static collection, sort by last_timestamp and write to queues
+    Read data from a static collection, sort by last_timestamp and write to queues. raw_queue is closed at the end
     :param default_param
         :param host: Database connection host name.
         :param port: Database connection port number.
@@ -39,6 +251,7 @@ def static_data_reader(default_param, db_param, raw_queue, query_filter, name=No
         :param database_name: Name of database to connect to (do not confuse with collection name).
         :param collection_name: Name of database collection from which to query.
     :param raw_queue: Process-safe queue to which records that are "ready" are written.  multiprocessing.Queue
+    :param query_filter: see fragment_filter
     :param dir: "eb" or "wb"
     :param: node: (str) compute_node_id for videonode
     :return:
@@ -52,69 +265,67 @@ def static_data_reader(default_param, db_param, raw_queue, query_filter, name=No
     logger.set_name(name)
     setattr(logger, "_default_logger_extra",  {})
      
-    # get parameters for fitting
-    logger.info("{} starts reading from {}.json".format(name, default_param["raw_collection"]))
-
-    min_queue_size = default_param["min_queue_size"]
-    discard = 0 # counter for short (<3) tracks
     cntr = 0
+    writer = batched_writer(raw_queue, default_param)
+    try:
+        for doc in read_fragments(default_param, logger, query_filter):
+            cntr += 1
+            writer.put(doc)          
+        writer.close()
+    
+    except Exception as e:
+        logger.warning("Other exceptions occured. Exit. Exception:{}".format(str(e)))
+        writer.flush() # not closed: the data is not read to the end
 
+    logger.info("Data reader closed. Read {} fragments. Exit {}.".format(cntr, name))
+
+    return
     
-    with open(default_param["raw_collection"]+'.json', 'rb') as f:
-        
-        try:
-            # keep filling the queues so that they are not low in stock
-            if raw_queue.qsize() <= min_queue_size :#or west_queue.qsize() <= min_queue_size:
-                
-                for doc in ijson.items(f, 'item'):
-                    cntr += 1
-
-                    if len(doc["timestamp"]) > 3: 
-                        # convert time series from decimal to float
-                        doc["timestamp"] = list(map(float, doc["timestamp"]))
-                        doc["x_position"] = list(map(float, doc["x_position"]))
-                        doc["y_position"] = list(map(float, doc["y_position"]))
-                        doc["width"] = list(map(float, doc["width"]))
-                        doc["length"] = list(map(float, doc["length"]))
-                        doc["height"] = list(map(float, doc["height"]))
-                        doc["velocity"] = list(map(float, doc["velocity"]))
-                        doc["detection_confidence"] = list(map(float, doc["detection_confidence"]))
-
-                        doc["first_timestamp"] = float(doc["first_timestamp"])
-                        doc["starting_x"] = float(doc["starting_x"])
-                        doc["ending_x"] = float(doc["ending_x"])
-                        doc["last_timestamp"] = float(doc["last_timestamp"])
-                        doc["_id"] = doc["_id"]["$oid"]
-                        doc["compute_node_id"] = 1
-                        
-                        doc = misc.interpolate(doc)
-                        # print(doc["_id"]["$oid"])
-                        # print(getattr(node, self.attr))
-                        raw_queue.put(doc)          
-                    else:
-                        print("****** discard ",doc["_id"])
-                        discard += 1
-
-
-            # if queue has sufficient number of items, then wait before the next iteration (throttle)
-            logger.info("** queue size is sufficient. wait")     
-            time.sleep(2)   
-         
-            
-        except StopIteration:  # rri reaches the end
-            logger.warning("static_data_reader reaches the end of query range iteration. Exit")
-        
-        except Exception as e:
-            logger.warning("Other exceptions occured. Exit. Exception:{}".format(str(e)))
 
+
+def static_data_demux_reader(default_param, db_param, queue_map, query_filter, name=None):
+    """
+    Read data from a static collection once and route each fragment to the queue of its direction. All queues are closed at the end
+    :param queue_map: {direction: queue}, e.g., {1: eb_queue, -1: wb_queue}. fragments of other directions are dropped
+    :return:
+    """
+    logger = log_writer.logger
+    if name is None:
+        name = "static_data_demux_reader"
+    logger.set_name(name)
+    setattr(logger, "_default_logger_extra",  {})
+    
+    HB = default_param["log_heartbeat"]
+    begin = time.time()
+    counts = {direction: 0 for direction in queue_map}
+    unrouted = 0
+    writers = {direction: batched_writer(q, default_param) for direction, q in queue_map.items()}
+    
+    try:
+        for doc in read_fragments(default_param, logger, query_filter):
+            try:
+                writer = writers[doc["direction"]]
+            except KeyError:
+                unrouted += 1
+                continue
+            writer.put(doc)
+            counts[doc["direction"]] += 1
+            
+            now = time.time()
+            if now - begin > HB:
+                logger.info("Fragments routed per direction: {}".format(counts))
+                begin = now
         
+        for writer in writers.values():
+            writer.close()
     
-    # logger.info("outside of while loop:qsize for raw_data_queue: east {}, west {}".format(east_queue.qsize(), west_queue.qsize()))
-    logger.debug("Discarded {} short tracks".format(discard))
-    logger.info("Data reader closed. Exit {}.".format(name))
-
-    return
+    except Exception as e:
+        logger.warning("Other exceptions occured. Exit. Exception:{}".format(str(e)))
+        for writer in writers.values(): # not closed: the data is not read to the end
+            writer.flush()
+    logger.info("Data reader closed. Fragments routed per direction: {}, unrouted: {}. Exit {}.".format(counts, unrouted, name))
     
+    return
 
     
 if __name__ == '__main__':
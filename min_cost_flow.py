@@ -12,6 +12,8 @@ import i24_logger.log_writer as log_writer
 from utils.utils_mcf import MOTGraphSingle
 from utils.misc import calc_fit, find_overlap_idx
 from utils.utils_opt import combine_fragments, resample
+from utils.utils_transport import batched_reader, batched_writer, attach_arrays, release_arrays, EndOfStream
+from utils.utils_checkpoint import Checkpointer
 # import multiprocessing
 # import _pickle as pickle
    
@@ -23,10 +25,9 @@ def min_cost_flow_online_alt_path(direction, fragment_queue, stitched_trajectory
     
     # Initiate a logger
     stitcher_logger = log_writer.logger
-    if name:
-        stitcher_logger.set_name(name)
-    else:
-        stitcher_logger.set_name("stitcher_"+direction)
+    if not name:
+        name = "stitcher_"+direction
+    stitcher_logger.set_name(name)
     stitcher_logger.info("** min_cost_flow_online_alt_path starts", extra = None)
     # setattr(stitcher_logger, "_default_logger_extra",  {})
 
@@ -37,34 +38,59 @@ def min_cost_flow_online_alt_path(direction, fragment_queue, stitched_trajectory
     # Initialize tracking graph
     m = MOTGraphSingle(direction=direction, attr=ATTR_NAME, parameters=parameters)
     
+    # exchange micro-batches with the neighboring stages, pending outputs are flushed while waiting for inputs
+    stitched_writer = batched_writer(stitched_trajectory_queue, parameters)
+    fragment_reader = batched_reader(fragment_queue, parameters, on_idle=stitched_writer.flush)
+    
     GET_TIMEOUT = parameters["stitcher_timeout"]
     HB = parameters["log_heartbeat"]
     begin = time.time()
     input_obj = 0
     output_obj = 0
     
+    # resume from the last checkpoint of a previous run of this process: the whole tracking graph with its cache and deque
+    checkpointer = Checkpointer(parameters, name)
+    state = checkpointer.load()
+    if state:
+        m, input_obj, output_obj = state["graph"], state["input_obj"], state["output_obj"]
+        stitcher_logger.info("Resume from checkpoint with {} fragments in cache".format(len(m.cache)))
+    
     while True:
         try:
             try:
-                fgmt = fragment_queue.get(timeout = GET_TIMEOUT) # a merged dictionary
+                fgmt = fragment_reader.get(timeout = GET_TIMEOUT) # a merged dictionary
                 
-            except queue.Empty: # queue is empty
-                stitcher_logger.info("Getting from fragment_queue timed out after {} sec.".format(GET_TIMEOUT))
+            except queue.Empty as e: # queue is closed, or empty for GET_TIMEOUT
+                if isinstance(e, EndOfStream):
+                    stitcher_logger.info("fragment_queue is closed.")
+                else:
+                    stitcher_logger.info("Getting from fragment_queue timed out after {} sec.".format(GET_TIMEOUT))
                 all_paths = m.get_all_traj()
                 
                 for path in all_paths:
 #                     print("queue empty path", path)
                     trajs = m.get_traj_dicts(path)
-                    stitched_trajectory_queue.put(trajs[::-1])
+                    stitched_writer.put(trajs[::-1])
                     input_obj += len(path)
                     output_obj += 1
 #                     stitcher_logger.info("final stitch together {}".format([trj for trj in path]))
                 
                 # stitcher_logger.info("fragment_queue is empty, exit.")
+                if isinstance(e, EndOfStream): # only close once the input is closed, see EndOfStream
+                    stitched_writer.close()
+                else:
+                    stitched_writer.flush()
+                checkpointer.clear()
                 stitcher_logger.info("Final flushing {} raw fragments --> {} stitched fragments".format(input_obj, output_obj),extra = None)
+                stitcher_logger.info(m.summary(), extra = None)
                 break
 
             fgmt_id = fgmt[ATTR_NAME]
+            if fgmt_id in m.cache: # sent again by a resumed merger
+                release_arrays(fgmt, copy=False)
+                continue
+            # fragments are held for a time window: take private copies, the shared segment is forwarded as is
+            attach_arrays(fgmt, copy=True)
             
             # t1 = time.time()
             # ============ Add node ============
@@ -89,7 +115,7 @@ def min_cost_flow_online_alt_path(direction, fragment_queue, stitched_trajectory
             for path in all_paths:
                 # print("pop path", path)
                 trajs = m.get_traj_dicts(path)
-                stitched_trajectory_queue.put(trajs[::-1])
+                stitched_writer.put(trajs[::-1])
                 m.clean_graph(path)
 #                 stitcher_logger.info("stitch together {}".format([trj for trj in path]))
                 
@@ -106,22 +132,32 @@ def min_cost_flow_online_alt_path(direction, fragment_queue, stitched_trajectory
                 stitcher_logger.info("MCF graph # nodes: {}, # edges: {}, deque: {}, cache: {}".format(m.G.number_of_nodes(), m.G.number_of_edges(), len(m.in_graph_deque), len(m.cache)),extra = None)
                 # stitcher_logger.info("Elapsed add:{:.2f}, augment:{:.2f}, pop:{:.2f}, total:{:.2f}".format(cum_t1, cum_t2, cum_t3, now-start), extra=None)
                 stitcher_logger.info("{} raw fragments --> {} stitched fragments".format(input_obj, output_obj),extra = None)
+                stitcher_logger.info(m.summary(), extra = None)
                 begin = time.time()
+                
+            if checkpointer.due():
+                stitched_writer.flush()
+                checkpointer.save({"graph": m, "input_obj": input_obj, "output_obj": output_obj})
             
         except (ConnectionResetError, BrokenPipeError, EOFError) as e:   
             stitcher_logger.warning("Connection error: {}".format(str(e)))
             break
             
-        except Exception as e: # other unknown exceptions are handled as error TODO UNTESTED CODE!
+        except Exception as e: # other unknown exceptions are handled as error
+            if checkpointer.exists(): # a restarted stitcher resumes the graph, flushing it would send the paths twice
+                stitcher_logger.error("Other error: {}, leave the graph to the checkpoint".format(e))
+                break
             stitcher_logger.error("Other error: {}, push all processed trajs to queue".format(e))
             
             all_paths = m.get_all_traj()
             for path in all_paths:
                 # print("exception path", path)
                 trajs = m.get_traj_dicts(path)
-                stitched_trajectory_queue.put(trajs[::-1])
+                stitched_writer.put(trajs[::-1])
                 input_obj += len(path)
                 output_obj += 1
+            stitched_writer.flush() # not closed: a restarted stitcher keeps writing to the queue
+            checkpointer.clear()
             stitcher_logger.info("Final flushing {} raw fragments --> {} stitched fragments".format(input_obj, 
                                                                                                     output_obj),
                                  extra = None)
@@ -135,9 +171,61 @@ def min_cost_flow_online_alt_path(direction, fragment_queue, stitched_trajectory
  
 
 if __name__ == '__main__':
-
+    # resume after an error in the middle of a run: a checkpoint after every fragment, then a fragment that raises.
+    # The stitcher exits without flushing, the restarted one takes over the graph. The paths are the same as an
+    # uninterrupted run and no fragment is sent twice
+    import json
+    import shutil
+    import tempfile
+    import numpy as np
+    from utils.utils_transport import BatchedQueueReader
+    with open("parameters.json") as f:
+        parameters = json.load(f)
+    parameters.update({"checkpoint_interval": 1e-9, "checkpoint_dir": tempfile.mkdtemp(), "shm_transport": False,
+                       "stitcher_timeout": 1, "stitcher_mode": "local", "compute_node_list": ["node"]})
+    ATTR_NAME = parameters["fragment_attr_name"]
+    
+    rng = np.random.default_rng(0)
+    fragments = []
+    for vehicle in range(100):
+        start, speed, lane = rng.uniform(0, 60), rng.uniform(50, 110), rng.integers(0, 4)
+        t = start + np.arange(0, rng.uniform(5, 40), 0.04)
+        x = rng.uniform(0, 2000) + speed*(t-start)
+        y = 6 + 12*lane + np.cumsum(rng.normal(0, 0.02, len(t)))
+        i = 0
+        while i < len(t) - 2:
+            j = min(i + int(rng.integers(25, 200)), len(t))
+            fragments.append({ATTR_NAME: len(fragments)+1, "direction": 1, "compute_node_id": "node", 
+                              "timestamp": 1628080000 + t[i:j], "x_position": x[i:j] + rng.normal(0, 0.3, j-i), 
+                              "y_position": y[i:j] + rng.normal(0, 0.1, j-i),
+                              "first_timestamp": 1628080000 + t[i], "last_timestamp": 1628080000 + t[j-1]})
+            i = j + int(rng.integers(5, 60)) # gap of 0.2 to 2.4 sec
+    fragments.sort(key=lambda fgmt: fgmt["last_timestamp"])
+    
+    def run_stitcher(parts):
+        # one stitcher per part on the same queues, return the fragment ids of all paths
+        fragment_queue, stitched_queue = queue.Queue(), queue.Queue()
+        for k, part in enumerate(parts):
+            for fgmt in part:
+                fragment_queue.put(dict(fgmt))
+            if k == len(parts)-1:
+                fragment_queue.put(EndOfStream())
+            else:
+                fragment_queue.put({"direction": 1}) # no id, the stitcher raises
+            min_cost_flow_online_alt_path("eb", fragment_queue, stitched_queue, parameters, name="stitcher_resume_test")
+        reader, paths = BatchedQueueReader(stitched_queue), []
+        while True:
+            try:
+                paths.append(sorted(trj[ATTR_NAME] for trj in reader.get(timeout=0)))
+            except queue.Empty:
+                return sorted(paths)
     
-    print("not implemented")
+    expected = run_stitcher([fragments])
+    resumed = run_stitcher([fragments[:len(fragments)//2], fragments[len(fragments)//2:]])
+    shutil.rmtree(parameters["checkpoint_dir"])
+    sent = [fid for path in resumed for fid in path]
+    print("resume after an error: {} paths, {} fragments sent twice".format(len(resumed), len(sent) - len(set(sent))))
+    assert resumed == expected, "resumed stitcher differs from an uninterrupted run"
     
     
     
\ No newline at end of file
@@ -2,11 +2,13 @@
 __file__ = 'pp_lite.py'
 __doc__ = """
 run only 1 pass, no parallel compute
-1 data reader, 1 merge, 1 mcc, for each direction, and 1 reconciliation in total
+1 data reader and 1 reconciliation in total, 1 merge and 1 mcc for each direction
 """
 # -----------------------------
 
 import multiprocessing as mp
+from multiprocessing import resource_tracker
+from multiprocessing.connection import wait
 import os
 import signal
 import time
@@ -19,6 +21,8 @@ import data_feed as df
 import min_cost_flow as mcf
 import reconciliation as rec
 import merge
+from utils.utils_transport import make_queue
+from utils.utils_checkpoint import clear_checkpoints
 
 
 
@@ -42,6 +46,12 @@ def main(raw_collection = None, reconciled_collection = None):
     manager_logger.set_name("postproc_manager")
     setattr(manager_logger, "_default_logger_extra",  {})
     HB = parameters["log_heartbeat"]
+    EXIT_GRACE = 5 # sec, see the supervisor loop
+    
+    # shared memory segments are created and released by different processes. Start one resource tracker for all of them
+    # before any fork, it unlinks the segments that are never released (e.g., a process is killed)
+    if parameters["shm_transport"]:
+        resource_tracker.ensure_running()
     
     # CREATE A MANAGER
     mp_manager = mp.Manager()
@@ -59,30 +69,34 @@ def main(raw_collection = None, reconciled_collection = None):
     directions = ["eb", "wb"]
             
     # -- master processes (not videonode specific) START AFTER ALL THE LOCAL PROCESSES DIE
+    # queue_transport selects manager proxies, multiprocessing queues or shared ring buffers (see utils_transport.make_queue)
     master_queues_map = {} # key:proc_name, val:queue that this process writes to
     for dir in directions:
-        master_queues_map[f"master_{dir}_feed"] = mp_manager.Queue() 
-        master_queues_map[f"master_{dir}_merge"] = mp_manager.Queue() 
-    master_queues_map["master_stitch"] = mp_manager.Queue() 
-    master_queues_map["master_reconcile"] = mp_manager.Queue() 
+        master_queues_map[f"master_{dir}_feed"] = make_queue(parameters, mp_manager) 
+        master_queues_map[f"master_{dir}_merge"] = make_queue(parameters, mp_manager) 
+    master_queues_map["master_stitch"] = make_queue(parameters, mp_manager, fan_in=True) # from both stitchers
+    master_queues_map["master_reconcile"] = make_queue(parameters, mp_manager, fan_in=True) # from the pool workers
     
     master_proc_map = defaultdict(dict)
     
+    # feed: parse the raw data once and route each fragment to the queue of its direction
+    master_proc_map["master_feed"]["command"] = df.static_data_demux_reader
+    master_proc_map["master_feed"]["args"] = (mp_param, db_param, 
+                                              {1 if dir=="eb" else -1: master_queues_map[f"master_{dir}_feed"] for dir in directions},
+                                              parameters["query_filter"], "master_feed",)
+    master_proc_map["master_feed"]["predecessor"] = None
+    master_proc_map["master_feed"]["dependent_queue"] = None
+    
     for dir in directions:
         
-        # feed
         key1 = "master_"+dir+"_feed"
-        master_proc_map[key1]["command"] = df.static_data_reader # TODO: modify data_feed
-        master_proc_map[key1]["args"] = (mp_param, db_param, master_queues_map[key1], 
-                                         {"direction":1 if dir=="eb" else -1},) # qeury from raw collection
-        master_proc_map[key1]["predecessor"] = None
-        master_proc_map[key1]["dependent_queue"] = None
         
         # merge
         key2 =  "master_"+dir+"_merge"
-        master_proc_map[key2]["command"] = merge.merge_fragments 
+        # several merge workers: this process becomes their coordinator, see merge.merge_fragments_partitioned
+        master_proc_map[key2]["command"] = merge.merge_fragments if parameters["merge_workers"] <= 1 else merge.merge_fragments_partitioned
         master_proc_map[key2]["args"] = (dir, master_queues_map[key1], master_queues_map[key2] , mp_param, key2, ) 
-        master_proc_map[key2]["predecessor"] = [key1]
+        master_proc_map[key2]["predecessor"] = ["master_feed"]
         master_proc_map[key2]["dependent_queue"] = [master_queues_map[key1]]
         
         # stitch
@@ -97,7 +111,7 @@ def main(raw_collection = None, reconciled_collection = None):
     master_proc_map["reconciliation"] = {"command": rec.reconciliation_pool,
                                       "args": (mp_param, db_param, 
                                                master_queues_map["master_stitch"],
-                                               master_queues_map["master_reconcile"] ,),
+                                               master_queues_map["master_reconcile"], len(directions), ),
                                       "predecessor": [f"master_{dir}_stitch" for dir in directions],
                                       "dependent_queue": [master_queues_map["master_stitch"]]}
     
@@ -106,6 +120,9 @@ def main(raw_collection = None, reconciled_collection = None):
                                       "predecessor": ["reconciliation"],
                                       "dependent_queue": [master_queues_map["master_reconcile"]]}
 
+    # checkpoints are only for processes resurrected within this run
+    clear_checkpoints(parameters, master_proc_map.keys())
+    
     # add PID to PID_tracker
     pid_tracker = {} # mp_manager.dict()
         
@@ -117,23 +134,25 @@ def main(raw_collection = None, reconciled_collection = None):
         master_proc_map[proc_name]["process"] = subsys_process # Process object cannot be pickled, thus local_proc_map cannot be a mp_manager.dict()
 
         
+    # supervisor: sleep until a process exits (its sentinel is ready) or a heartbeat is due, no polling in between
     start = time.time()
     begin = start
     while True:
+        alive = [proc_info["process"].sentinel for proc_info in master_proc_map.values() if proc_info["process"].is_alive()]
+        if alive:
+            wait(alive, timeout=HB)
         now = time.time()
-        if now - begin > 14400 and all([q.empty() for _,q in master_queues_map.items()]): # 4hr
-            manager_logger.info("Master processes exceed running for 4hr and all queues are empty.")
-            break
         
-        if now - begin > 20 and all([q.empty() for _,q in master_queues_map.items()]) and \
-        not any([master_proc_map[proc]["process"].is_alive() for proc in master_proc_map]):
-            manager_logger.info("Master processes complete in {} sec.".format(now-begin))
-            break
-            
-
+        # same resurrection policy as before, only evaluated when something changed or at heartbeats
         for proc_name, proc_info in master_proc_map.items():
 
             if not proc_info["process"].is_alive():
+                # a stage that got the end-of-stream of its predecessors may exit before they do,
+                # give them a moment to shut down before deciding that this one died early
+                grace_end = time.time() + EXIT_GRACE
+                for pred in proc_info["predecessor"] or []:
+                    # join, not wait on the sentinel: it is ready slightly before is_alive() turns False
+                    master_proc_map[pred]["process"].join(timeout=max(0, grace_end - time.time()))
                 pred_alive = [False] if not proc_info["predecessor"] else \
                 [master_proc_map[pred]["process"].is_alive() for pred in proc_info["predecessor"]]
                 queue_empty = [True] if not proc_info["dependent_queue"] else \
@@ -150,9 +169,16 @@ def main(raw_collection = None, reconciled_collection = None):
                     subsys_process.start()
                     pid_tracker[proc_name] = subsys_process.pid
                     master_proc_map[proc_name]["process"] = subsys_process 
+        
+        if not any([proc_info["process"].is_alive() for proc_info in master_proc_map.values()]):
+            manager_logger.info("Master processes complete in {} sec.".format(now-begin))
+            break
+        
+        if now - begin > 14400 and all([q.empty() for _,q in master_queues_map.items()]): # 4hr
+            manager_logger.info("Master processes exceed running for 4hr and all queues are empty.")
+            break
             
         # Heartbeat queue sizes
-        now = time.time()
         if now - start > HB:
             for proc_name, q in master_queues_map.items():
                 if not q.empty():
@@ -18,9 +18,11 @@ import queue
 import i24_logger.log_writer as log_writer
 from decimal import Decimal
 import json
+import numpy as np
 
 # from utils.utils_reconciliation import receding_horizon_2d_l1, resample, receding_horizon_2d, combine_fragments, rectify_2d
 from utils.utils_opt import combine_fragments, resample, opt1, opt2, opt1_l1, opt2_l1, opt2_l1_constr
+from utils.utils_transport import Batch, batched_reader, share_arrays, attach_arrays, release_arrays, EndOfStream
     
 
 # Custom JSON encoder to handle Decimal objects
@@ -28,20 +30,16 @@ class DecimalEncoder(json.JSONEncoder):
     def default(self, o):
         if isinstance(o, Decimal):
             return str(o)  # Convert Decimal to a string representation
+        if isinstance(o, np.ndarray):
+            return o.tolist()
         return super().default(o)
     
     
-def reconcile_single_trajectory(reconciliation_args, combined_trajectory, reconciled_queue) -> None:
+def _reconcile(reconciliation_args, combined_trajectory, rec_worker_logger):
     """
-    Resample and reconcile a single trajectory, and write the result to a queue
-    :param next_to_reconcile: a trajectory document
-    :return:
+    Resample and reconcile a single trajectory
+    :return: the reconciled trajectory, None if reconciliation is skipped
     """
-    
-    rec_worker_logger = log_writer.logger 
-    rec_worker_logger.set_name("rec_worker")
-    setattr(rec_worker_logger, "_default_logger_extra",  {})
-
     resampled_trajectory = resample(combined_trajectory, dt=0.04)
     if "post_flag" in resampled_trajectory:
         # skip reconciliation
@@ -52,25 +50,102 @@ def reconcile_single_trajectory(reconciliation_args, combined_trajectory, reconc
             # finished_trajectory = rectify_2d(resampled_trajectory, reg = "l1", **reconciliation_args)  
             finished_trajectory = opt2_l1_constr(resampled_trajectory, **reconciliation_args)  
             # finished_trajectory = opt2(resampled_trajectory, **reconciliation_args)  
-            reconciled_queue.put(finished_trajectory)
+            return finished_trajectory
             # rec_worker_logger.debug("*** Reconciled a trajectory, duration: {:.2f}s, length: {}".format(finished_trajectory["last_timestamp"]-finished_trajectory["first_timestamp"], len(finished_trajectory["timestamp"])), extra = None)
         
         except Exception as e:
             rec_worker_logger.info("+++ Flag as {}, skip reconciliation".format(str(e)), extra = None)
+    
+    return None
+    
+    
+def reconcile_single_trajectory(reconciliation_args, combined_trajectory, reconciled_queue) -> None:
+    """
+    Resample and reconcile a single trajectory, and write the result to a queue
+    :param next_to_reconcile: a trajectory document
+    :return:
+    """
+    
+    rec_worker_logger = log_writer.logger 
+    rec_worker_logger.set_name("rec_worker")
+    setattr(rec_worker_logger, "_default_logger_extra",  {})
+
+    finished_trajectory = _reconcile(reconciliation_args, combined_trajectory, rec_worker_logger)
+    if finished_trajectory is not None:
+        reconciled_queue.put(finished_trajectory)
+
+
+
+def combine_shared_fragments(traj_docs):
+    """
+    combine_fragments on fragments that come with shared memory handles. The segments are released once combined
+    """
+    for doc in traj_docs:
+        attach_arrays(doc)
+    combined_trajectory = combine_fragments(traj_docs)
+    for doc in traj_docs:
+        release_arrays(doc, copy=False)
+    return combined_trajectory
+
+
+
+_reconciled_queue = None # set in each pool worker by init_worker
+
+def init_worker(reconciled_queue):
+    """
+    Pool initializer. The output queue is inherited by the workers instead of passed with every task,
+    multiprocessing.Queue and RingQueue cannot be pickled into apply_async
+    """
+    global _reconciled_queue
+    _reconciled_queue = reconciled_queue
+
+
+
+def reconcile_trajectory_batch(reconciliation_args, combined_trajectories, shm=False) -> None:
+    """
+    Resample and reconcile a micro-batch of trajectories, and write the results to the worker's queue as one Batch
+    :param combined_trajectories: a list of trajectory documents
+    :param shm: combined_trajectories are lists of shared fragments (see utils_transport) to be combined here,
+        and the results are shared as well
+    :return:
+    """
+    
+    rec_worker_logger = log_writer.logger 
+    rec_worker_logger.set_name("rec_worker")
+    setattr(rec_worker_logger, "_default_logger_extra",  {})
+
+    finished = Batch()
+    for traj_docs in combined_trajectories: # one failed trajectory does not lose the rest of the batch
+        try:
+            combined_trajectory = combine_shared_fragments(traj_docs) if shm else traj_docs
+            finished_trajectory = _reconcile(reconciliation_args, combined_trajectory, rec_worker_logger)
+            if finished_trajectory is not None:
+                finished.append(share_arrays(finished_trajectory) if shm else finished_trajectory)
+        except Exception as e:
+            rec_worker_logger.warning("+++ {}, skip the trajectory".format(e), extra = None)
+            if shm: # the segments that combine_shared_fragments did not release
+                for doc in traj_docs:
+                    try:
+                        release_arrays(doc, copy=False)
+                    except FileNotFoundError: # already gone
+                        pass
+    if finished:
+        _reconciled_queue.put(finished)
 
 
 
 def reconciliation_pool(parameters, db_param, stitched_trajectory_queue: multiprocessing.Queue, 
-                        reconciled_queue: multiprocessing.Queue, ) -> None:
+                        reconciled_queue: multiprocessing.Queue, n_producers=1) -> None:
     """
     Start a multiprocessing pool, each worker 
     :param stitched_trajectory_queue: results from stitchers, shared by mp.manager
+    :param n_producers: number of stitchers writing to stitched_trajectory_queue, the pool closes after all of them
     :param pid_tracker: a dictionary
     :return:
     """
 
     n_proc = min(multiprocessing.cpu_count(), parameters["worker_size"])
-    worker_pool = Pool(processes= n_proc)
+    worker_pool = Pool(processes= n_proc, initializer=init_worker, initargs=(reconciled_queue,))
 
     
     # parameters
@@ -86,26 +161,48 @@ def reconciliation_pool(parameters, db_param, stitched_trajectory_queue: multipr
     
     rec_parent_logger.info("** Reconciliation pool starts. Pool size: {}".format(n_proc), extra = None)
     TIMEOUT = parameters["reconciliation_pool_timeout"]
+    BATCH_SIZE = parameters["queue_batch_size"]
+    SHM = parameters["shm_transport"]
+    
+    # trajectories are dispatched to the workers in micro-batches, pending ones are dispatched while waiting for inputs
+    # with shm_transport, only the handles of the fragments are dispatched and the workers combine them
+    pending = []
+    def dispatch():
+        if pending:
+            worker_pool.apply_async(reconcile_trajectory_batch, (reconciliation_args, list(pending), SHM, ),
+                                    error_callback=lambda e: rec_parent_logger.error("Reconciliation batch failed: {}".format(e)))
+            pending.clear()
+    stitched_reader = batched_reader(stitched_trajectory_queue, parameters, on_idle=dispatch, n_producers=n_producers)
     
     cntr = 0
+    closed = False # all stitchers closed their queue
     while True:
         try:
             try:
-                traj_docs = stitched_trajectory_queue.get(timeout = TIMEOUT) #20sec
+                traj_docs = stitched_reader.get(timeout = TIMEOUT) #20sec
                 cntr += 1
-            except queue.Empty: 
-                rec_parent_logger.warning("Reconciliation pool is timed out after {}s. Close the reconciliation pool.".format(TIMEOUT))
+            except queue.Empty as e: 
+                if isinstance(e, EndOfStream):
+                    rec_parent_logger.info("All stitchers are done. Close the reconciliation pool.")
+                    closed = True
+                else:
+                    rec_parent_logger.warning("Reconciliation pool is timed out after {}s. Close the reconciliation pool.".format(TIMEOUT))
+                dispatch()
                 worker_pool.close()
                 break
-            if isinstance(traj_docs, list):
-                combined_trajectory = combine_fragments(traj_docs)
+            if not isinstance(traj_docs, list):
+                traj_docs = [traj_docs]
+            if SHM:
+                pending.append(traj_docs)
             else:
-                combined_trajectory = combine_fragments([traj_docs])
-            # combined_trajectory = combine_fragments(traj_docs)  
-            worker_pool.apply_async(reconcile_single_trajectory, (reconciliation_args, combined_trajectory, reconciled_queue, ))
+                combined_trajectory = combine_fragments(traj_docs)
+                pending.append(combined_trajectory)
+            if len(pending) >= BATCH_SIZE:
+                dispatch()
 
         except Exception as e: # other exception
             rec_parent_logger.warning("{}, Close the pool".format(e))
+            dispatch()
             worker_pool.close() # wait until all processes finish their task
             break
             
@@ -113,6 +210,8 @@ def reconciliation_pool(parameters, db_param, stitched_trajectory_queue: multipr
         
     # Finish up  
     worker_pool.join()
+    if closed: # all workers are done. Otherwise the queue is left open for a restarted pool
+        reconciled_queue.put(EndOfStream())
     rec_parent_logger.info("Joined the pool.")
     
     return
@@ -140,14 +239,20 @@ def write_reconciled_to_db(parameters, db_param, reconciled_queue):
             fh.truncate()
         print("removed last character")
 
+    reconciled_reader = batched_reader(reconciled_queue, parameters)
+    
     # Write to db
     while True:
 
         try:
-            record = reconciled_queue.get(timeout = TIMEOUT)
+            record = reconciled_reader.get(timeout = TIMEOUT)
+        except EndOfStream:
+            reconciled_writer.info("reconciled_queue is closed.")
+            break
         except queue.Empty:
             reconciled_writer.warning("Getting from reconciled_queue reaches timeout {} sec.".format(TIMEOUT))
             break
+        release_arrays(attach_arrays(record)) # shm_transport: copy the arrays out of the segment and release it
 
         # TODO: write one
         file_exists = os.path.exists(output_filename)
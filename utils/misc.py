@@ -1,5 +1,6 @@
 from i24_logger.log_writer import catch_critical
 import numpy as np
+import heapq
 from sklearn import linear_model
 from scipy.stats import linregress
 
@@ -44,6 +45,30 @@ def interpolate(traj):
     return traj
 
 
+RAW_TIME_SERIES_FIELDS = ["timestamp", "x_position", "y_position", "width", "length", "height", 
+                          "velocity", "detection_confidence"]
+
+
+def prepare_raw_doc(doc):
+    '''
+    convert a raw document (as parsed by ijson) to the format the pipeline consumes
+    - time series from decimal to float
+    - _id from {"$oid": id} to id
+    - interpolate nans in x_position and y_position
+    '''
+    for key in RAW_TIME_SERIES_FIELDS:
+        doc[key] = list(map(float, doc[key]))
+
+    doc["first_timestamp"] = float(doc["first_timestamp"])
+    doc["starting_x"] = float(doc["starting_x"])
+    doc["ending_x"] = float(doc["ending_x"])
+    doc["last_timestamp"] = float(doc["last_timestamp"])
+    doc["_id"] = doc["_id"]["$oid"]
+    doc["compute_node_id"] = 1
+    
+    return interpolate(doc)
+
+
 @catch_critical(errors = (Exception))
 def add_filter(traj, raw, residual_threshold_x, residual_threshold_y, 
                conf_threshold, remain_threshold):
@@ -488,10 +513,136 @@ class SortedDLL:
                 s += ", "   # if not the last node, add the comma and space
             x = x.next
         s += "]"
-        return s      
-        
-    
-    
-    
+        return s
+
+
+
+class ExpiryNode:
+    '''
+    entry of ExpiryHeap, ordered by (tail_time, seq)
+    '''
+    __slots__ = ("id", "tail_time", "seq")
+
+    def __init__(self, id, tail_time, seq):
+        self.id = id
+        self.tail_time = tail_time
+        self.seq = seq
+
+    def __repr__(self):
+        return 'ExpiryNode({!r})'.format(self.id)
+
+
+
+class ExpiryHeap:
+    '''
+    drop-in replacement of SortedDLL (keyed on "id", sorted by "tail_time") as a lazy-deletion binary heap
+    append, update and delete are O(log n) / O(1) instead of a linear walk: update and delete only retire the
+    current entry of a key, stale entries are dropped when they reach the top (first_node), and the heap is
+    rebuilt when more than half of it is stale
+    ties in tail_time are broken by the order of append / update, the last one comes last, same as SortedDLL
+    '''
+    def __init__(self, attr = "id"):
+        self.heap = [] # (tail_time, seq, id), compared as tuples
+        self.cache = {} # key: id, val: current ExpiryNode of that id
+        self.seq = 0
+        self.attr = attr
+
+    def count(self):
+        return len(self.cache)
+
+    def _push(self, key, tail_time):
+        node = ExpiryNode(key, tail_time, self.seq)
+        self.seq += 1
+        self.cache[key] = node
+        heapq.heappush(self.heap, (tail_time, node.seq, key))
+        if len(self.heap) > 2 * len(self.cache) + 64: # compact stale entries
+            self.heap = [(node.tail_time, node.seq, node.id) for node in self.cache.values()]
+            heapq.heapify(self.heap)
+
+    def append(self, node):
+        if isinstance(node, dict):
+            self._push(node[self.attr], node["tail_time"])
+        else:
+            self._push(getattr(node, self.attr), node.tail_time)
+
+    def delete(self, node):
+        key = node if not isinstance(node, (ExpiryNode, Node)) else getattr(node, self.attr)
+        return self.cache.pop(key, None) # the heap entry becomes stale
+
+    def update(self, key, attr_val, attr_name = "tail_time"):
+        if key not in self.cache:
+            raise KeyError(key)
+        self._push(key, attr_val)
+
+    def first_node(self):
+        heap, cache = self.heap, self.cache
+        while heap:
+            _, seq, key = heap[0]
+            node = cache.get(key)
+            if node is not None and node.seq == seq:
+                return node
+            heapq.heappop(heap)
+        return None
+
+    def get_attr(self, attr_name="tail_time"):
+        nodes = sorted(self.cache.values(), key=lambda node: (node.tail_time, node.seq))
+        if attr_name == "self":
+            return nodes
+        return [getattr(node, attr_name) for node in nodes]
+
+    def __repr__(self):
+        return "[" + ", ".join(str(node.id) for node in self.get_attr("self")) + "]"
+
+
+
+if __name__ == '__main__':
+    # microbenchmark of SortedDLL vs ExpiryHeap on the access pattern of merge_fragments:
+    # append a new component per fragment, unions delete one component and update the tail of the other,
+    # and the components older than the time window are popped from the front
+    import time
+    import random
+
+    def workload(n_ops, window, seed=0):
+        rng = random.Random(seed)
+        ops, alive, tails, t = [], [], {}, 0.0
+        for i in range(n_ops):
+            t += rng.uniform(0, 0.02)
+            ops.append(("append", i, t))
+            if alive and rng.random() < 0.4: # absorbed by a component in the window, whose tail moves to the end
+                j = alive[rng.randrange(len(alive))]
+                ops.append(("delete", i, None))
+                ops.append(("update", j, t))
+                tails[j] = t
+            else:
+                alive.append(i)
+                tails[i] = t
+            ops.append(("expire", None, t - window*0.01))
+            alive = [j for j in alive if tails[j] >= t - window*0.01]
+        return ops
+
+    def run(structure, ops):
+        popped = []
+        t1 = time.time()
+        for op, key, val in ops:
+            if op == "append":
+                structure.append({"id": key, "tail_time": val})
+            elif op == "delete":
+                structure.delete(key)
+            elif op == "update":
+                structure.update(key=key, attr_val=val)
+            else:
+                while True:
+                    first = structure.first_node()
+                    if first is not None and first.tail_time < val:
+                        popped.append(first.id)
+                        structure.delete(first.id)
+                    else:
+                        break
+        return time.time() - t1, popped
 
-      
\ No newline at end of file
+    for window in [100, 1000, 5000]:
+        ops = workload(20000, window)
+        t_dll, p_dll = run(SortedDLL(), ops)
+        t_heap, p_heap = run(ExpiryHeap(), ops)
+        print("window {:>5}: SortedDLL {:.3f} sec, ExpiryHeap {:.3f} sec, same expiry order: {}".format(
+            window, t_dll, t_heap, p_dll == p_heap))
@@ -0,0 +1,61 @@
+'''
+Periodic checkpoints of the state of the merge and stitch stages, so that a resurrected process resumes where the
+dead one left off instead of starting from an empty state
+- a checkpoint is a pickle file <checkpoint_dir>/<process name>.pkl, written atomically (temporary file, then rename)
+- enabled with parameters["checkpoint_interval"] > 0 (sec)
+- a stage removes its checkpoint when it finishes cleanly, pp_lite removes stale ones at start
+- on an error, a stage with a checkpoint exits without flushing its state: the restarted process resumes it, a flush
+  would send it twice. Without one it flushes as before
+'''
+import os
+import time
+import pickle
+
+
+class Checkpointer:
+    '''
+    save / load / clear the checkpoint of one process
+    due() is True every checkpoint_interval sec. Flush the output of the stage before save(), so that the
+    checkpoint never covers messages that have not left the process yet
+    '''
+    def __init__(self, parameters, name):
+        self.interval = parameters["checkpoint_interval"]
+        self.path = os.path.join(parameters["checkpoint_dir"], name + ".pkl")
+        self.last = time.time()
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    def due(self):
+        return self.enabled and time.time() - self.last > self.interval
+
+    def save(self, state):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path)
+        self.last = time.time()
+
+    def exists(self):
+        return self.enabled and os.path.exists(self.path)
+
+    def load(self):
+        '''
+        return the last saved state, None if there is none
+        '''
+        if not self.exists():
+            return None
+        with open(self.path, "rb") as f:
+            return pickle.load(f)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+
+def clear_checkpoints(parameters, names):
+    for name in names:
+        Checkpointer(parameters, name).clear()
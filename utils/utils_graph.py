@@ -0,0 +1,336 @@
+'''
+Residual graph of the online min cost flow stitcher (utils_mcf.MOTGraphSingle), two interchangeable backends
+- NxStitchGraph: networkx.DiGraph with weight / match attributes per edge, as the stitcher always had
+- ArrayStitchGraph: integer node slots and numpy arrays for the edges, neighbor scans are vectorized
+make_stitch_graph picks one by parameters["stitcher_graph"]
+
+The graph has a sink "t" and one node per fragment (or compressed chain of fragments). add_fragment adds the edge
+t->node (weight 0, matched) and the edges node->earlier fragment (weight stitch_thresh - cost, unmatched).
+Matching invariant kept by MOTGraphSingle.augment_path: every fragment node has exactly one matched in-edge
+(from t if it ends a path) and at most one matched out-edge
+'''
+import numpy as np
+import networkx as nx
+
+
+class NxStitchGraph:
+    '''
+    the stitching graph on networkx.DiGraph
+    an edge to a node that is not in the graph (cleaned, but still in the window of MOTGraphSingle) creates it without
+    attributes. Such nodes have no matched in-edge, so they never appear in a path, and are removed once isolated
+    '''
+    def __init__(self):
+        self.G = nx.DiGraph()
+        self.G.add_node("t")
+        self.G.nodes["t"]["subpath"] = []
+
+    def __contains__(self, node):
+        return node in self.G.nodes
+
+    def number_of_nodes(self):
+        return self.G.number_of_nodes()
+
+    def number_of_edges(self):
+        return self.G.number_of_edges()
+
+    def add_fragment(self, node, last_timestamp, successors):
+        '''
+        successors: list of (earlier fragment id, weight)
+        '''
+        self.G.add_edge("t", node, weight=0, match=True)
+        self.G.nodes[node]["subpath"] = [node] # list of ids
+        self.G.nodes[node]["last_timestamp"] = last_timestamp
+        for succ, weight in successors:
+            self.G.add_edge(node, succ, weight=weight, match=False)
+
+    def remove_node(self, node):
+        '''
+        KeyError if node is not in the graph
+        '''
+        try:
+            self.G.remove_node(node)
+        except nx.exception.NetworkXError:
+            raise KeyError(node)
+
+    def remove_isolates(self):
+        self.G.remove_nodes_from(list(nx.isolates(self.G)))
+
+    def subpath(self, node):
+        return self.G.nodes[node]["subpath"]
+
+    def legal_neighbors(self, node):
+        '''
+        [u, v, delta] for every unmatched node->u and matched v->u with delta = weight(node, u) - weight(v, u) > 0
+        '''
+        nei = []
+        for u in self.G.adj[node]:
+            if not self.G[node][u]["match"]:
+                cost_p = self.G[node][u]["weight"]
+                for v,_ ,data in self.G.in_edges(u, data=True):
+                    if data["match"]:
+                        cost_m = self.G[v][u]["weight"]
+                        if cost_p - cost_m > 0:
+                            nei.append([u,v,cost_p - cost_m])
+        return nei
+
+    def set_match(self, u, v, match):
+        self.G[u][v]["match"] = match
+
+    def next_match(self, node):
+        '''
+        the head of the matched out-edge of node, None if there is none
+        '''
+        for curr, next, data in self.G.out_edges(node, data=True):
+            if data["match"]:
+                return next
+        return None
+
+    def matched_predecessor(self, node):
+        '''
+        the tail of the matched in-edge of node other than t, None if there is none or node is not in the graph
+        '''
+        if node not in self.G.nodes:
+            return None
+        for v,_,data in self.G.in_edges(node, data = True):
+            if data["match"] and v != "t":
+                return v
+        return None
+
+    def tails(self, time_thresh=None):
+        '''
+        the nodes with a matched edge from t (ends of paths), in insertion order
+        time_thresh: only the ones with last_timestamp < time_thresh
+        '''
+        return [tail for tail in self.G.adj["t"] if self.G["t"][tail]["match"] and
+                (time_thresh is None or self.G.nodes[tail]["last_timestamp"] < time_thresh)]
+
+
+
+class ArrayStitchGraph:
+    '''
+    the stitching graph on arrays
+    - nodes: integer slots, recycled through a free list. Per slot: generation (bumped when the slot is freed), last_timestamp,
+      insertion order, whether the edge from t is matched, the matched in-edge (an edge index, T for the edge from t,
+      NONE) and the out-edge block
+    - edges: the out-edges of a node are added all at once (add_fragment), so they are stored as one contiguous block
+      [out_start, out_start + out_len) of the edge arrays (CSR-like): owner slot, head slot, generation of the head at
+      insertion, weight, match. The edges from t are the per-slot flags
+    - an edge is live while the generation of its head slot is unchanged. Removing a node frees its block only, the
+      edges into it go stale in the blocks of other nodes
+    - blocks are appended at the end of the edge arrays. When a block does not fit, the live blocks are compacted to the
+      front, in allocation order, into arrays of the smallest power-of-two multiple of the initial capacity that is at
+      least twice the live edges (as utils_merge.SampleArena)
+    edges to nodes that are not in the graph are not added: networkx would create a bare node for them, which can
+    never be part of a path (no matched in-edge). Isolated nodes cannot appear otherwise, and remove_isolates does nothing
+    '''
+    T = -2 # matched in-edge from t
+    NONE = -1
+
+    def __init__(self, capacity=1<<10, edge_capacity=1<<14):
+        self.slot = {} # key: node id, val: slot
+        self.ids = [None] * capacity # node id of every slot
+        self.subpaths = [None] * capacity
+        self.free = list(range(capacity-1, -1, -1)) # free slots, the last one is used first
+        self.gen = np.zeros(capacity, dtype=np.int64)
+        self.last_timestamp = np.full(capacity, np.nan)
+        self.order = np.zeros(capacity, dtype=np.int64)
+        self.t_match = np.zeros(capacity, dtype=bool)
+        self.in_match = np.full(capacity, self.NONE, dtype=np.int64)
+        self.out_start = np.zeros(capacity, dtype=np.int64)
+        self.out_len = np.zeros(capacity, dtype=np.int64)
+        self.seq = 0
+
+        self.initial_edge_capacity = edge_capacity
+        self.src = np.zeros(edge_capacity, dtype=np.int64)
+        self.dst = np.zeros(edge_capacity, dtype=np.int64)
+        self.dst_gen = np.zeros(edge_capacity, dtype=np.int64)
+        self.weight = np.zeros(edge_capacity)
+        self.match = np.zeros(edge_capacity, dtype=bool)
+        self.end = 0 # first free edge
+        self.live_edges = 0 # edges in the blocks of live nodes, stale or not
+
+    def __contains__(self, node):
+        return node in self.slot
+
+    def number_of_nodes(self):
+        return len(self.slot) + 1 # and t
+
+    def number_of_edges(self):
+        n = 0
+        for s in self.slot.values():
+            a, b = self.out_start[s], self.out_start[s] + self.out_len[s]
+            n += np.count_nonzero(self.gen[self.dst[a:b]] == self.dst_gen[a:b])
+        return n + len(self.slot)
+
+    def _grow_nodes(self):
+        n = len(self.ids)
+        self.ids.extend([None] * n)
+        self.subpaths.extend([None] * n)
+        self.free.extend(range(2*n-1, n-1, -1))
+        self.gen = np.concatenate([self.gen, np.zeros(n, dtype=np.int64)])
+        self.last_timestamp = np.concatenate([self.last_timestamp, np.full(n, np.nan)])
+        self.order = np.concatenate([self.order, np.zeros(n, dtype=np.int64)])
+        self.t_match = np.concatenate([self.t_match, np.zeros(n, dtype=bool)])
+        self.in_match = np.concatenate([self.in_match, np.full(n, self.NONE, dtype=np.int64)])
+        self.out_start = np.concatenate([self.out_start, np.zeros(n, dtype=np.int64)])
+        self.out_len = np.concatenate([self.out_len, np.zeros(n, dtype=np.int64)])
+
+    def _compact(self, n):
+        capacity = self.initial_edge_capacity
+        while capacity < 2 * (self.live_edges + n):
+            capacity *= 2
+        slots = np.array(sorted(self.slot.values(), key=lambda s: self.out_start[s]), dtype=np.int64)
+        starts, lengths = self.out_start[slots], self.out_len[slots]
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        pos = np.arange(offsets[-1]) - np.repeat(offsets[:-1] - starts, lengths) # live positions, in order
+        new_index = np.full(len(self.src), self.NONE, dtype=np.int64)
+        new_index[pos] = np.arange(len(pos))
+        for name in ["src", "dst", "dst_gen", "weight", "match"]:
+            col = getattr(self, name)
+            new = np.zeros(capacity, dtype=col.dtype)
+            new[:len(pos)] = col[pos]
+            setattr(self, name, new)
+        self.out_start[slots] = offsets[:-1]
+        edge = self.in_match >= 0
+        self.in_match[edge] = new_index[self.in_match[edge]] # the matched in-edges are in live blocks
+        self.end = len(pos)
+
+    def add_fragment(self, node, last_timestamp, successors):
+        '''
+        successors: list of (earlier fragment id, weight), the ones that are not in the graph are skipped
+        '''
+        if not self.free:
+            self._grow_nodes()
+        s = self.free.pop()
+        self.slot[node] = s
+        self.ids[s] = node
+        self.subpaths[s] = [node]
+        self.last_timestamp[s] = last_timestamp
+        self.order[s] = self.seq
+        self.seq += 1
+        self.t_match[s] = True
+        self.in_match[s] = self.T
+
+        successors = [(self.slot[succ], weight) for succ, weight in successors if succ in self.slot]
+        n = len(successors)
+        if self.end + n > len(self.src):
+            self._compact(n)
+        a = self.end
+        if n:
+            dst, weight = zip(*successors)
+            self.src[a:a+n] = s
+            self.dst[a:a+n] = dst
+            self.dst_gen[a:a+n] = self.gen[list(dst)]
+            self.weight[a:a+n] = weight
+            self.match[a:a+n] = False
+        self.out_start[s], self.out_len[s] = a, n
+        self.end += n
+        self.live_edges += n
+
+    def remove_node(self, node):
+        '''
+        KeyError if node is not in the graph
+        '''
+        s = self.slot.pop(node)
+        a, b = self.out_start[s], self.out_start[s] + self.out_len[s]
+        # the heads of its matched out-edges lose their matched in-edge
+        e = a + np.flatnonzero(self.match[a:b] & (self.gen[self.dst[a:b]] == self.dst_gen[a:b]))
+        heads = self.dst[e]
+        lost = self.in_match[heads] == e
+        self.in_match[heads[lost]] = self.NONE
+
+        self.live_edges -= b - a
+        if not self.slot: # nothing live, start over at the front
+            self.end = 0
+        self.gen[s] += 1 # the edges into s go stale
+        self.ids[s] = self.subpaths[s] = None
+        self.t_match[s] = False
+        self.in_match[s] = self.NONE
+        self.out_len[s] = 0
+        self.free.append(s)
+
+    def remove_isolates(self):
+        pass
+
+    def subpath(self, node):
+        return self.subpaths[self.slot[node]]
+
+    def legal_neighbors(self, node):
+        '''
+        [u, v, delta] for every unmatched node->u and matched v->u with delta = weight(node, u) - weight(v, u) > 0
+        the edges from t have weight 0, and no edge has a negative weight, so there are none for t
+        '''
+        if node == "t":
+            return []
+        s = self.slot[node]
+        a, b = self.out_start[s], self.out_start[s] + self.out_len[s]
+        if a == b:
+            return []
+        u = self.dst[a:b]
+        m = self.in_match[u]
+        delta = self.weight[a:b] - np.where(m >= 0, self.weight[m], 0)
+        legal = np.flatnonzero(~self.match[a:b] & (self.gen[u] == self.dst_gen[a:b]) & (m != self.NONE) & (delta > 0))
+        return [[self.ids[ui], "t" if mi == self.T else self.ids[self.src[mi]], d]
+                for ui, mi, d in zip(u[legal].tolist(), m[legal].tolist(), delta[legal].tolist())]
+
+    def _edge(self, u, v):
+        # index of the live edge u->v, KeyError if there is none
+        su, sv = self.slot[u], self.slot[v]
+        a, b = self.out_start[su], self.out_start[su] + self.out_len[su]
+        e = np.flatnonzero((self.dst[a:b] == sv) & (self.dst_gen[a:b] == self.gen[sv]))
+        if not len(e):
+            raise KeyError((u, v))
+        return a + e[0]
+
+    def set_match(self, u, v, match):
+        if u == "t":
+            sv, e = self.slot[v], self.T
+            self.t_match[sv] = match
+        else:
+            e = self._edge(u, v)
+            sv = self.dst[e]
+            self.match[e] = match
+        if match:
+            self.in_match[sv] = e
+        elif self.in_match[sv] == e:
+            self.in_match[sv] = self.NONE
+
+    def next_match(self, node):
+        '''
+        the head of the matched out-edge of node, None if there is none
+        '''
+        s = self.slot[node]
+        a, b = self.out_start[s], self.out_start[s] + self.out_len[s]
+        e = np.flatnonzero(self.match[a:b] & (self.gen[self.dst[a:b]] == self.dst_gen[a:b]))
+        return self.ids[self.dst[a + e[0]]] if len(e) else None
+
+    def matched_predecessor(self, node):
+        '''
+        the tail of the matched in-edge of node other than t, None if there is none or node is not in the graph
+        '''
+        s = self.slot.get(node)
+        if s is None or self.in_match[s] < 0:
+            return None
+        return self.ids[self.src[self.in_match[s]]]
+
+    def tails(self, time_thresh=None):
+        '''
+        the nodes with a matched edge from t (ends of paths), in insertion order
+        time_thresh: only the ones with last_timestamp < time_thresh
+        '''
+        sel = self.t_match if time_thresh is None else self.t_match & (self.last_timestamp < time_thresh)
+        slots = np.flatnonzero(sel)
+        return [self.ids[s] for s in slots[np.argsort(self.order[slots], kind="stable")].tolist()]
+
+
+
+def make_stitch_graph(parameters):
+    '''
+    the graph backend of parameters["stitcher_graph"]: "array" or "networkx"
+    '''
+    backend = parameters["stitcher_graph"]
+    if backend == "array":
+        return ArrayStitchGraph()
+    if backend == "networkx":
+        return NxStitchGraph()
+    raise ValueError("Unknown stitcher_graph {}".format(backend))
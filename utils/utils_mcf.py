@@ -1,10 +1,9 @@
 import numpy as np
-import networkx as nx
 import queue
 from collections import deque
-from utils.utils_stitcher_cost import stitch_cost, stitch_cost_simple_distance
+from utils.utils_stitcher_cost import stitch_cost, stitch_cost_batch, stitch_cost_simple_distance_batch, motion_ends
+from utils.utils_graph import make_stitch_graph
 # from scipy import stats
-from i24_logger.log_writer import catch_critical
 import itertools
 import _pickle as pickle
 
@@ -29,6 +28,135 @@ class Fragment():
         
 
 
+class PredecessorIndex:
+    '''
+    the fragments of in_graph_deque in buckets of their tail time (bucket sec), each bucket with its fragments sorted
+    by ending x. query(fragment) returns, newest first, the fragments that add_node would score and that can reach
+    the head of fragment within stitch_thresh:
+        - same as the scan of add_node: only the fragments after the newest one with gap > time_win, and gap >= 0
+          (stitch_cost is 1e6 otherwise)
+        - the position cone: stitch_cost is bd/n + 0.1*gap, and for a pair within stitch_thresh the Bhattacharyya term
+          of the measured sample next to the gap is at most n*(stitch_thresh - 0.1*gap) (n <= 25 samples, all terms are
+          non-negative). With K = sqrt(200*(stitch_thresh - 0.1*gap)), the fitted slope s, the slope v used for the
+          prediction (clamped to the direction) and the residual r of the fit at the end next to the gap:
+              |head x - ending x| <= K*cx + r1 + gap*(K*mx*|s1| + |v1|)          the earlier fragment is the anchor
+              |head x - ending x| <= K*(cx + mx*(gap+span1)*|s2|) + r2 + gap*|v2|  the new fragment is the anchor
+          (1: tail of the earlier fragment, span1 the duration of its tail window, 2: head of the new fragment)
+          a fragment outside both cones cannot be stitched to the new one
+    fragments with non-finite ends are always returned
+    '''
+    def __init__(self, bucket, time_win, param):
+        self.bucket = bucket
+        self.time_win = time_win
+        self.thresh = param["stitch_thresh"]
+        self.cx, self.mx = param["cx"], param["mx"]
+        self.buckets = {} # key: bucket index, val: {id: entry}
+        self.arrays = {} # key: bucket index, val: entries as arrays sorted by ending x, rebuilt after a change
+        self.where = {} # key: id, val: bucket index
+        self.seq = 0
+    
+    def __len__(self):
+        return len(self.where)
+    
+    def _K(self, gap):
+        return np.sqrt(200 * np.maximum(self.thresh - 0.1*gap, 0))
+    
+    @staticmethod
+    def _end(end, direction, i):
+        # fitted slope, slope of the prediction and residual of the line at sample i (the one next to the gap)
+        t0, tm, xm, ym, slopex, slopey, _ = end[3]
+        v = slopex if slopex * direction >= 0 else 0
+        return abs(slopex), abs(v), abs(xm + v * ((end[0][i] - t0) - tm) - end[1][i])
+    
+    def insert(self, fragment, ends, fragment_id):
+        t, x = fragment["timestamp"], fragment["x_position"]
+        tail = ends["tail"]
+        s, v, r = self._end(tail, fragment["direction"], -1)
+        entry = (fragment, self.seq, t[-1], x[-1], r, s, v, tail[0][-1] - tail[0][0])
+        self.seq += 1
+        key = int(np.floor(t[-1] / self.bucket)) if np.isfinite(t[-1]) else None
+        self.buckets.setdefault(key, {})[fragment_id] = entry
+        self.arrays.pop(key, None)
+        self.where[fragment_id] = key
+        
+    def remove(self, fragment_id):
+        key = self.where.pop(fragment_id)
+        del self.buckets[key][fragment_id]
+        if not self.buckets[key]:
+            del self.buckets[key]
+        self.arrays.pop(key, None)
+            
+    def _arrays(self, key):
+        # entries of a bucket as arrays sorted by ending x (non-finite last), the entries with non-finite ends,
+        # and scalars for the bucket: max seq, tail time range, maxima of the finite ends for the x window
+        if key not in self.arrays:
+            entries = sorted(self.buckets[key].values(), key=lambda e: (not np.isfinite(e[3]), e[3] if np.isfinite(e[3]) else 0))
+            frags = [e[0] for e in entries]
+            seq, t_tail, x_end, r, s, v, span = (np.array([e[i] for e in entries], dtype=np.float64) for i in range(1, 8))
+            n_finite = int(np.count_nonzero(np.isfinite(x_end)))
+            fin = np.isfinite(r) & np.isfinite(s) & np.isfinite(v) & np.isfinite(span)
+            loose = np.flatnonzero(~fin[:n_finite])
+            tail = np.concatenate([loose, np.arange(n_finite, len(frags))]) # always returned, whatever x_head
+            scalars = (seq.max(), t_tail.min(), t_tail.max()) + tuple(col[fin].max(initial=0) for col in (r, s, v, span))
+            self.arrays[key] = (frags, seq, t_tail, x_end, r, s, v, span, n_finite, tail, scalars)
+        return self.arrays[key]
+    
+    def query(self, fragment, ends):
+        '''
+        fragments that may be stitched to fragment (the new one), newest first. ends: motion_ends of fragment
+        '''
+        t_head, x_head = fragment["timestamp"][0], fragment["x_position"][0]
+        s2, v2, r2 = self._end(ends["head"], fragment["direction"], 0)
+        bounded = bool(np.isfinite([t_head, x_head, s2, v2, r2]).all())
+        b, tw, cx, mx = self.bucket, self.time_win, self.cx, self.mx
+        eps = 1e-3 # sec, rounding of the bucket keys
+        
+        # the scan of add_node stops at the newest fragment with gap > time_win
+        cut = -1
+        for key in self.buckets:
+            if key is None or key * b > t_head - tw + eps:
+                continue
+            frags, seq, t_tail, *_, scalars = self._arrays(key)
+            if (key + 1) * b < t_head - tw - eps: # the whole bucket is older
+                cut = max(cut, scalars[0])
+            elif scalars[0] > cut:
+                old = seq[t_head - t_tail > tw]
+                if len(old):
+                    cut = max(cut, old.max())
+        
+        found = []
+        for key in self.buckets:
+            if key is not None and (key * b > t_head + eps or (key + 1) * b < t_head - tw - eps): # tail after the head, or too old
+                continue
+            frags, seq, t_tail, x_end, r, s, v, span, n_finite, tail, scalars = self._arrays(key)
+            seq_max, t_min, t_max, r_max, s_max, v_max, span_max = scalars
+            if seq_max <= cut:
+                continue
+            with np.errstate(invalid="ignore", over="ignore"):
+                if key is not None and bounded: # x window of the whole bucket, then the cone of every fragment in it
+                    G, K = t_head - t_min, self._K(max(t_head - t_max, 0))
+                    W = max(K*cx + r_max + G*(K*mx*s_max + v_max), K*(cx + mx*(G + span_max)*s2) + r2 + G*v2) * (1 + 1e-9) + 1e-9
+                    lo = np.searchsorted(x_end[:n_finite], x_head - W, side="left")
+                    hi = np.searchsorted(x_end[:n_finite], x_head + W, side="right")
+                    sel = np.arange(lo, hi)
+                    if len(tail):
+                        sel = np.concatenate([sel, tail[(tail < lo) | (tail >= hi)]])
+                    if not len(sel):
+                        continue
+                    g = t_head - t_tail[sel]
+                    K = self._K(g)
+                    cone = np.maximum(K*cx + r[sel] + g*(K*mx*s[sel] + v[sel]), K*(cx + mx*(g + span[sel])*s2) + r2 + g*v2)
+                    sel = sel[~(np.abs(x_head - x_end[sel]) > cone * (1 + 1e-9) + 1e-9)] # non-finite ends are kept
+                else:
+                    sel = np.arange(len(frags))
+                gap = t_head - t_tail[sel]
+                sel = sel[(seq[sel] > cut) & ~(gap < 0) & ~(gap > tw)]
+            found.extend((seq[i], frags[i]) for i in sel)
+        found.sort(key=lambda e: -e[0])
+        return [fgmt for _, fgmt in found]
+    
+    
+    
 class MOTGraphSingle:
     '''
     same as MOT_Graph except that every fragment is represented as a single node. this is equivalent to say that the inclusion cost for each fragment is 0, or the false positive rate is 0
@@ -36,11 +164,7 @@ class MOTGraphSingle:
     '''
     def __init__(self, direction=None, attr = "ID", parameters = None):
         # self.parameters = parameters
-        self.G = nx.DiGraph()
-        # self.G.add_nodes_from(["s","t"])
-        # self.G.nodes["s"]["subpath"] = []
-        self.G.add_node("t")
-        self.G.nodes["t"]["subpath"] = []
+        self.G = make_stitch_graph(parameters) # networkx or arrays, see utils_graph
         self.all_paths = []
         self.attr = attr
         self.in_graph_deque = deque() # keep track of fragments that are currently in graph, ordered by last_timestamp
@@ -55,6 +179,14 @@ class MOTGraphSingle:
             self.param["time_win"] = parameters["time_win"]
         self.compute_node_pos_map = {key:val for val,key in enumerate(parameters["compute_node_list"])}   
         self.cache = {}
+        self.ends = {} # key: id, val: motion_ends of the fragments in in_graph_deque, fitted once for all their pairs
+        # fragments of in_graph_deque by tail time and ending x, only the ones that can reach a new fragment are scored
+        bucket = parameters["stitch_index_bucket"]
+        self.index = PredecessorIndex(bucket, self.param["time_win"], self.param) if bucket > 0 else None
+        # cheap first stage: pairs whose stitch_cost_simple_distance exceeds it are not scored, None to disable
+        self.cascade = parameters["stitch_cascade_thresh"]
+        self.cascade_max = -np.inf # largest simple distance of a pair that got an edge
+        self.num_cost, self.num_cascade = 0, 0 # stitch_cost evaluations, pairs rejected by the simple distance
         self.direction = direction
           
     # @catch_critical(errors = (Exception))
@@ -68,12 +200,8 @@ class MOTGraphSingle:
         '''
         # new_id = getattr(fragment, self.attr)
         new_id = fragment[self.attr]
-        self.G.add_edge("t", new_id, weight=0, match=True)
-        self.G.nodes[new_id]["subpath"] = [new_id] # list of ids
-        self.G.nodes[new_id]["last_timestamp"] = fragment["last_timestamp"]
-        # self.G.nodes[new_id]["ending_x"] = fragment["ending_x"]
-        # self.G.nodes[new_id]["filters"] = [fragment["filter"]] # list of lists
         self.cache[new_id] = fragment
+        self.ends[new_id] = motion_ends(fragment)
             
         nc = len(self.in_graph_deque)
         node_id = fragment["compute_node_id"]
@@ -82,51 +210,69 @@ class MOTGraphSingle:
             node_diff_thresh = 0
         else:
             node_diff_thresh = 1
-        for i in range(nc):
-            fgmt = self.in_graph_deque[nc-1-i]
-            # if timeout, no need to check for older fragments
-            gap = fragment["timestamp"][0] - fgmt["timestamp"][-1] 
-            if gap > self.param["time_win"]:
-                break
+        eligible = [] # earlier fragments that may be stitched to the new one, newest first
+        if self.index is not None:
+            predecessors = self.index.query(fragment, self.ends[new_id])
+        else:
+            predecessors = []
+            for i in range(nc):
+                fgmt = self.in_graph_deque[nc-1-i]
+                # if timeout, no need to check for older fragments
+                gap = fragment["timestamp"][0] - fgmt["timestamp"][-1] 
+                if gap > self.param["time_win"]:
+                    break
+                predecessors.append(fgmt)
                 
+        for fgmt in predecessors:
             fgmt_node_id = fgmt["compute_node_id"]
-            # print(str(fgmt["_id"])[-4:], fgmt_node_id)
-            
-            # stitch the same node_id in local mode
-            # if self.stitcher_mode == "local" and fgmt_node_id == node_id:
-            #     cost = stitch_cost(fgmt, fragment, self.TIME_WIN, self.param)
-
+            # stitch the same node_id in local mode, other pairs cost 1e5 (no edge)
             if abs(self.compute_node_pos_map[node_id]-self.compute_node_pos_map[fgmt_node_id]) <= node_diff_thresh:
-                cost = stitch_cost(fgmt, fragment, self.TIME_WIN, self.param)
-#                 print(str(fgmt["_id"])[-4:], str(fragment["_id"])[-4:], cost)
-            else:
-                cost = 1e5
-            
-            if cost <= self.param["stitch_thresh"]:  # new edge points from new_id to existing nodes, with postive cost
-                fgmt_id = fgmt[self.attr]
-                self.G.add_edge(new_id, fgmt_id, weight = self.param["stitch_thresh"]-cost, match = False)
+                eligible.append(fgmt)
+        
+        simple = None
+        if self.cascade is not None and eligible: # nan distances are kept
+            simple = stitch_cost_simple_distance_batch(eligible, fragment, self.TIME_WIN)
+            keep = np.flatnonzero(~(simple > self.cascade))
+            self.num_cascade += len(eligible) - len(keep)
+            eligible = [eligible[i] for i in keep]
+            simple = simple[keep]
+        
+        # all the pairs at once
+        self.num_cost += len(eligible)
+        costs = stitch_cost_batch(eligible, fragment, self.TIME_WIN, self.param, 
+                                  [self.ends[fgmt[self.attr]] for fgmt in eligible], self.ends[new_id])
+        if simple is not None and len(simple):
+            self.cascade_max = max(self.cascade_max, np.nanmax(simple[costs <= self.param["stitch_thresh"]], initial=-np.inf))
+        
+        # edge t->new_id is matched, new edges point from new_id to existing nodes, with postive cost
+        successors = [(fgmt[self.attr], self.param["stitch_thresh"]-cost) for fgmt, cost in zip(eligible, costs)
+                      if cost <= self.param["stitch_thresh"]]
+        self.G.add_fragment(new_id, fragment["last_timestamp"], successors)
         
         # add Fragment pointer to cache
         self.in_graph_deque.append(fragment)
+        if self.index is not None:
+            self.index.insert(fragment, self.ends[new_id], new_id)
 
         # check for time-out fragments in deque and compress paths
         while self.in_graph_deque[0]["last_timestamp"] < fragment["first_timestamp"] - self.TIME_WIN:
             fgmt = self.in_graph_deque.popleft()
             fgmt_id = fgmt[self.attr]
-            try:
-                for v,_,data in self.G.in_edges(fgmt_id, data = True):
-                    if data["match"] and v != "t":
-                        # compress fgmt and v -> roll up subpath 
-                        # TODO: need to check the order
-                        self.G.nodes[v]["subpath"].extend(self.G.nodes[fgmt_id]["subpath"])
-                        # self.G.nodes[v]["filters"].extend(self.G.nodes[fgmt_id]["filters"])
-                        self.G.remove_node(fgmt_id)
-                        break
-            except nx.exception.NetworkXError:
-                # if fgmt_id in self.G.nodes(): 
-                #     print(f"{fgmt_id} is not cleaned during add_node")
-                pass
+            self.ends.pop(fgmt_id, None)
+            if self.index is not None:
+                self.index.remove(fgmt_id)
+            v = self.G.matched_predecessor(fgmt_id) # None if fgmt_id is already cleaned
+            if v is not None:
+                # compress fgmt and v -> roll up subpath 
+                # TODO: need to check the order
+                self.G.subpath(v).extend(self.G.subpath(fgmt_id))
+                self.G.remove_node(fgmt_id)
 
+    def summary(self):
+        text = "stitch_cost evaluated on {} pairs".format(self.num_cost)
+        if self.cascade is None:
+            return text + "."
+        return text + ", {} rejected by simple distance (largest with an edge: {:.4g}).".format(self.num_cascade, self.cascade_max)
         
     # @catch_critical(errors = (Exception))
     def verify_path(self, path, cost_thresh = 10):
@@ -137,7 +283,7 @@ class MOTGraphSingle:
         for id1, id2 in comb:
             f1 = self.cache[id1]
             f2 = self.cache[id2]
-            cost = stitch_cost(f1, f2, self.TIME_WIN, self.param)
+            cost = stitch_cost(f1, f2, self.TIME_WIN, self.param, self.ends.get(id1), self.ends.get(id2))
             # print(cost)
             if cost > cost_thresh:
                 return False # detect high cost
@@ -170,17 +316,7 @@ class MOTGraphSingle:
         cost(x, u) - cost(u,v) > 0, and (x,u) is unmatched, and (u,v) is matched i.e., positive delta if x steals u from v
         the idea is similar to alternating path in Hungarian algorithm
         '''
-        nei = []
-        for u in self.G.adj[node]:
-            if not self.G[node][u]["match"]:
-                cost_p = self.G[node][u]["weight"]
-                # print(node, u, cost_p)
-                for v,_ ,data in self.G.in_edges(u, data=True):
-                    if data["match"]:
-                        cost_m = self.G[v][u]["weight"]
-                        if cost_p - cost_m > 0:
-                            nei.append([u,v,cost_p - cost_m])
-                        
+        nei = self.G.legal_neighbors(node) # [[u, v, cost(x, u) - cost(u,v)], ...]
         # print("legal nei for {} is {}".format(node, nei))
         return nei
 
@@ -241,18 +377,14 @@ class MOTGraphSingle:
             forward = True
             for i in range(len(alt_path)-1):
                 if forward:
-                    self.G[alt_path[i]][alt_path[i+1]]["match"] = True
+                    self.G.set_match(alt_path[i], alt_path[i+1], True)
                 else:
-                    self.G[alt_path[i+1]][alt_path[i]]["match"] = False
+                    self.G.set_match(alt_path[i+1], alt_path[i], False)
                 forward = not forward
         
     # @catch_critical(errors = (Exception))
     def get_next_match(self, node):
-        for curr, next, data in self.G.out_edges(node, data=True):
-            if data["match"]:
-                # print(curr, next, data)
-                return next
-        return None  
+        return self.G.next_match(node)
     
     
     # @catch_critical(errors = (Exception))
@@ -269,15 +401,14 @@ class MOTGraphSingle:
                 self.all_paths.append(list(path))
                 
                 return list(path)
-            path = path + self.G.nodes[node]["subpath"]
+            path = path + self.G.subpath(node)
             next = self.get_next_match(node)
             # print("curr: {},next: {}".format(node, next))
             return dfs(next, path)
             
-        tails =  self.G.adj["t"]
+        tails =  self.G.tails() # matched to t
         for tail in tails:
-            if self.G["t"][tail]["match"]:
-                one_path = dfs(tail, [])
+            one_path = dfs(tail, [])
                 # self.clean_graph([i for sublist in self.all_paths for i in sublist])
                 
         return self.all_paths
@@ -299,40 +430,25 @@ class MOTGraphSingle:
                 
                 return list(path)
             
-            path = path + self.G.nodes[node]["subpath"]
+            path = path + self.G.subpath(node)
             next = self.get_next_match(node)
             return dfs(next, path)
             
-        tails =  self.G.adj["t"]
+        tails =  self.G.tails(time_thresh) # matched to t and timed out
         
         for tail in tails:
-            if tail in self.G.nodes and self.G["t"][tail]["match"] \
-            and self.G.nodes[tail]["last_timestamp"] < time_thresh:
-#                 if (self.direction == "eb" and self.G.nodes[tail]["ending_x"] <= dist_thresh) \
-#                     or (self.direction == "wb" and self.G.nodes[tail]["ending_x"] > dist_thresh):
-                one_path = dfs(tail, [])
+            one_path = dfs(tail, [])
                 
-                # print("*** tail: ", tail, one_path)
-                # self.clean_graph(one_path)
+            # print("*** tail: ", tail, one_path)
+            # self.clean_graph(one_path)
                 
         # 6/11/2023 remove isolated nodes in G TODO: not sure why they appear in the first place
-        self.G.remove_nodes_from(list(nx.isolates(self.G)))
+        self.G.remove_isolates()
         
                 
         return all_paths
         
     
-    # @catch_critical(errors = (Exception))
-    def get_filters(self, path):
-        filters = []
-        for _id in path:
-            try:
-                filters.extend(self.G.nodes[_id]["filters"])
-            except KeyError:
-                pass
-        return filters
-    
-    
     # @catch_critical(errors = (Exception))
     def get_traj_dicts(self, path):
         '''
@@ -349,4 +465,72 @@ class MOTGraphSingle:
         
        
 if __name__ == '__main__':
-    print("not implemented")
\ No newline at end of file
+    # python -m utils.utils_mcf, on synthetic traffic over 4 miles (vehicles cut into fragments with short gaps)
+    # - edges of MOTGraphSingle with the predecessor index against the linear scan of in_graph_deque
+    # - paths of the stitcher loop of min_cost_flow with the array graph against the networkx graph
+    import json
+    import time
+    import copy
+    with open("parameters.json") as f:
+        parameters = json.load(f)
+    parameters["stitcher_mode"] = "local"
+    parameters["compute_node_list"] = ["node"]
+    
+    rng = np.random.default_rng(0)
+    fragments = []
+    for vehicle in range(1500):
+        start, speed, lane = rng.uniform(0, 300), rng.uniform(50, 110), rng.integers(0, 4)
+        t = start + np.arange(0, rng.uniform(5, 40), 0.04)
+        x = rng.uniform(0, 20000) + speed*(t-start) + np.cumsum(rng.normal(0, 0.05, len(t)))
+        y = 6 + 12*lane + np.cumsum(rng.normal(0, 0.02, len(t)))
+        i = 0
+        while i < len(t) - 2:
+            n = int(rng.integers(25, 200))
+            j = min(i + n, len(t))
+            fragments.append({"ID": len(fragments)+1, "direction": 1, "compute_node_id": "node", 
+                              "timestamp": 1628080000 + t[i:j], "x_position": x[i:j] + rng.normal(0, 0.3, j-i), 
+                              "y_position": y[i:j] + rng.normal(0, 0.1, j-i),
+                              "first_timestamp": 1628080000 + t[i], "last_timestamp": 1628080000 + t[j-1]})
+            i = j + int(rng.integers(5, 60)) # gap of 0.2 to 2.4 sec
+    fragments.sort(key=lambda fgmt: fgmt["last_timestamp"])
+    
+    edges = {}
+    for bucket in [0, parameters["stitch_index_bucket"] or 5]:
+        param = copy.deepcopy(parameters)
+        param["stitch_index_bucket"] = bucket
+        param["stitcher_graph"] = "networkx"
+        m = MOTGraphSingle(direction="eb", attr="ID", parameters=param)
+        n_deque = 0
+        t1 = time.time()
+        for fgmt in fragments:
+            n_deque += len(m.in_graph_deque)
+            m.add_node(fgmt)
+        t2 = time.time()
+        edges[bucket] = sorted((str(u), str(v), d["weight"]) for u, v, d in m.G.G.edges(data=True))
+        print("stitch_index_bucket={}: {} fragments, {:.0f} in the deque on average, add_node: {:.3f} sec".format(
+              bucket, len(fragments), n_deque/len(fragments), t2-t1))
+    assert edges[0] == edges[bucket]
+    
+    paths = {}
+    for backend in ["networkx", "array"]:
+        param = copy.deepcopy(parameters)
+        param["stitcher_graph"] = backend
+        m = MOTGraphSingle(direction="eb", attr="ID", parameters=param)
+        paths[backend] = []
+        elapsed = {"add_node": 0, "augment_path": 0, "pop_path": 0}
+        for fgmt in fragments:
+            t1 = time.time()
+            m.add_node(fgmt)
+            t2 = time.time()
+            m.augment_path(fgmt["ID"])
+            t3 = time.time()
+            for path in m.pop_path(time_thresh = fgmt["first_timestamp"] - param["time_win"]):
+                paths[backend].append(path)
+                m.clean_graph(path)
+            t4 = time.time()
+            for key, dt in zip(elapsed, [t2-t1, t3-t2, t4-t3]):
+                elapsed[key] += dt
+        paths[backend].extend(m.get_all_traj())
+        print("stitcher_graph={}: {} paths, {}".format(backend, len(paths[backend]), 
+              ", ".join("{}: {:.3f} sec".format(key, dt) for key, dt in elapsed.items())))
+    assert paths["networkx"] == paths["array"]
@@ -0,0 +1,297 @@
+'''
+Data structures for merge_fragments
+- MergeCandidateIndex: incremental spatial index over the fragments in the merge graph, so that merge_cost
+  is only evaluated on the fragments that can possibly be merged with a new one
+- DisjointSet: union-find over fragment ids, keeps the members and the latest tail_time of every component
+- SampleArena: columnar storage of the resampled time series of the fragments in the window
+- coarse_summary: block envelopes of a fragment, for the lower bound of the merge cost (merge.merge_cost_lower_bound)
+- merge_shards: the workers of the (y band, x segment) shards of a fragment, for merge.merge_fragments_partitioned
+'''
+import math
+import warnings
+import numpy as np
+
+
+class MergeCandidateIndex:
+    '''
+    grid over the x axis. A fragment is registered in every cell that its padded x range covers,
+    padded by its mean length as in merge_cost (at the end for direction 1, at the start otherwise)
+    query(track) returns, in insertion order, the ids of the fragments that
+        - overlap track in time (strictly) and in padded x range, i.e., merge_cost would not return 1e5
+        - are not too far apart in y: the gap g between the y ranges bounds the cost from below by
+          0.0625*g^2/((wmax1+wmax2)/2) (Bhattacharyya terms for x and for the covariance are non-negative,
+          and there are K terms over K+1). The pair is skipped if this bound exceeds thresh
+    fragments with NaN bounds are always returned, like merge_cost would evaluate them
+    '''
+    MAX_CELLS = 1000 # fragments spanning more cells are kept in the unbounded list
+
+    def __init__(self, cell_size, thresh):
+        self.cell_size = cell_size
+        self.thresh = thresh
+        self.cells = {} # key: cell index, val: set of ids
+        self.unbounded = set() # ids with an unknown (NaN) or too large x range
+        self.entries = {} # key: id, val: (insertion sequence, bounds)
+        self.seq = 0
+
+    @staticmethod
+    def bounds(track):
+        '''
+        first, last timestamp, padded x range, y range and max width of a resampled fragment
+        '''
+        t = track["timestamp"]
+        x = track["x_position"]
+        sx, ex = min(x[0], x[-1]), max(x[0], x[-1])
+        with warnings.catch_warnings(): # all-nan fields give nan bounds
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            l = np.nanmean(track["length"])
+            ymin, ymax = np.nanmin(track["y_position"]), np.nanmax(track["y_position"])
+            wmax = np.nanmax(track["width"])
+        if track["direction"] == 1:
+            ex = ex + l
+        else:
+            sx = sx - l
+        return float(t[0]), float(t[-1]), float(sx), float(ex), float(ymin), float(ymax), float(wmax)
+
+    def _cell_range(self, sx, ex):
+        if math.isnan(sx) or math.isnan(ex):
+            return None
+        c0, c1 = math.floor(sx/self.cell_size), math.floor(ex/self.cell_size)
+        if c1 - c0 > self.MAX_CELLS:
+            return None
+        return range(c0, c1+1)
+
+    def insert(self, track_id, track):
+        b = self.bounds(track)
+        self.entries[track_id] = (self.seq, b)
+        self.seq += 1
+        cells = self._cell_range(b[2], b[3])
+        if cells is None:
+            self.unbounded.add(track_id)
+        else:
+            for c in cells:
+                self.cells.setdefault(c, set()).add(track_id)
+
+    def remove(self, track_id):
+        _, b = self.entries.pop(track_id)
+        cells = self._cell_range(b[2], b[3])
+        if cells is None:
+            self.unbounded.discard(track_id)
+        else:
+            for c in cells:
+                ids = self.cells[c]
+                ids.discard(track_id)
+                if not ids:
+                    del self.cells[c]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_bounds(self, track_id):
+        return self.entries[track_id][1]
+
+    def query(self, track):
+        t0, t1, sx, ex, ymin, ymax, wmax = self.bounds(track)
+        cells = self._cell_range(sx, ex)
+        if cells is None:
+            ids = set(self.entries)
+        else:
+            ids = set(self.unbounded)
+            for c in cells:
+                ids.update(self.cells.get(c, ()))
+
+        candidates = []
+        for track_id in ids:
+            seq, (c0, c1, csx, cex, cymin, cymax, cwmax) = self.entries[track_id]
+            if c1 <= t0 or t1 <= c0 or csx > ex or sx > cex: # same test as merge_cost, nan passes
+                continue
+            gap = max(cymin - ymax, ymin - cymax) # nan if either y range is unknown
+            if gap > 0 and 0.0625 * gap**2 > self.thresh * (cwmax + wmax)/2:
+                continue
+            candidates.append((seq, track_id))
+
+        candidates.sort()
+        return [track_id for _, track_id in candidates]
+
+
+
+class DisjointSet:
+    '''
+    union-find with path compression and union by size
+    every root keeps the member list and the max tail_time of its component, so that a whole component
+    can be popped without a graph traversal
+    '''
+    def __init__(self):
+        self.parent = {}
+        self.members = {} # key: root, val: list of ids in the component
+        self.tail = {} # key: root, val: max tail_time in the component
+
+    def __contains__(self, x):
+        return x in self.parent
+
+    def __len__(self):
+        return len(self.parent)
+
+    def add(self, x, tail_time):
+        self.parent[x] = x
+        self.members[x] = [x]
+        self.tail[x] = tail_time
+
+    def find(self, x):
+        root = x
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[x] != root: # path compression
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, x, y):
+        '''
+        merge the components of x and y, return (root, absorbed root). absorbed root is None if they were already one
+        '''
+        rx, ry = self.find(x), self.find(y)
+        if rx == ry:
+            return rx, None
+        if len(self.members[rx]) < len(self.members[ry]):
+            rx, ry = ry, rx
+        self.parent[ry] = rx
+        self.members[rx].extend(self.members.pop(ry))
+        self.tail[rx] = max(self.tail[rx], self.tail.pop(ry))
+        return rx, ry
+
+    def pop(self, root):
+        '''
+        remove the component of root, return its members
+        '''
+        members = self.members.pop(root)
+        self.tail.pop(root)
+        for x in members:
+            del self.parent[x]
+        return members
+
+    def components(self):
+        return list(self.members.items())
+
+
+
+class SampleArena:
+    '''
+    time series of the fragments in the merge window, one preallocated array per field (structure of arrays)
+    a fragment occupies the slice [start, start+n) of every field, slices are allocated at the end
+    when a new fragment does not fit, the live slices are compacted to the front, in allocation order, into arrays of
+    the smallest power-of-two multiple of the initial capacity that is at least twice the live samples. The space of
+    the fragments that left the window is recycled and the memory follows the window size, not the length of the run
+    - get(id): views of the slice of a fragment, valid until the next insert
+    - pop(id): copies, the slice is freed
+    - columns and slices: the whole window at once, e.g., for vectorized scans
+    '''
+    def __init__(self, fields, capacity=1<<16):
+        self.fields = list(fields)
+        self.initial_capacity = capacity
+        self.columns = {field: np.empty(capacity) for field in self.fields}
+        self.slices = {} # key: id, val: (start, n), in allocation order
+        self.end = 0 # first free position
+        self.live = 0 # number of samples in use
+
+    @property
+    def capacity(self):
+        return len(self.columns[self.fields[0]])
+
+    def __contains__(self, track_id):
+        return track_id in self.slices
+
+    def __len__(self):
+        return len(self.slices)
+
+    def _compact(self, n):
+        capacity = self.initial_capacity
+        while capacity < 2 * (self.live + n):
+            capacity *= 2
+        if self.slices:
+            starts, lengths = map(np.array, zip(*self.slices.values()))
+            offsets = np.concatenate([[0], np.cumsum(lengths)])
+            pos = np.arange(offsets[-1]) - np.repeat(offsets[:-1] - starts, lengths) # live positions, in order
+        else:
+            offsets, pos = np.zeros(1, dtype=int), np.zeros(0, dtype=int)
+        for field in self.fields:
+            col = self.columns[field]
+            new = np.empty(capacity) if capacity != len(col) else col
+            new[:len(pos)] = col[pos] # gathered first, safe in place
+            self.columns[field] = new
+        self.slices = {track_id: (int(offsets[i]), n_i) for i, (track_id, (_, n_i)) in enumerate(self.slices.items())}
+        self.end = len(pos)
+
+    def insert(self, track_id, track):
+        n = len(track[self.fields[0]])
+        if self.end + n > self.capacity:
+            self._compact(n)
+        for field in self.fields:
+            self.columns[field][self.end:self.end+n] = track[field]
+        self.slices[track_id] = (self.end, n)
+        self.end += n
+        self.live += n
+
+    def get(self, track_id):
+        start, n = self.slices[track_id]
+        return {field: self.columns[field][start:start+n] for field in self.fields}
+
+    def pop(self, track_id):
+        start, n = self.slices.pop(track_id)
+        self.live -= n
+        if not self.slices: # nothing live, start over at the front
+            self.end = 0
+        return {field: self.columns[field][start:start+n].copy() for field in self.fields}
+
+
+
+def coarse_summary(track, factor):
+    '''
+    decimated summary of a resampled fragment: min and max of x and y over blocks of factor samples
+    (25 Hz / factor), the max length and width, and whether all lengths and widths are positive.
+    nan samples are ignored, all-nan blocks give nan envelopes
+    return (xmin, xmax, ymin, ymax, lmax, wmax, positive)
+    '''
+    n = len(track["x_position"])
+    starts = np.arange(0, n, factor)
+    env = []
+    for key in ["x_position", "y_position"]:
+        val = np.asarray(track[key], dtype=np.float64)
+        env.append(np.fmin.reduceat(val, starts))
+        env.append(np.fmax.reduceat(val, starts))
+    with warnings.catch_warnings(): # all-nan fields give nan
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        env.append(float(np.nanmax(track["length"])))
+        env.append(float(np.nanmax(track["width"])))
+        env.append(bool(np.nanmin(track["length"]) > 0 and np.nanmin(track["width"]) > 0))
+    return tuple(env)
+
+
+
+def merge_shards(bounds, thresh, band_width, segment_length, n_workers):
+    '''
+    workers that a fragment is sent to in the partitioned merge. The road is cut in y bands of band_width and x segments
+    of segment_length (ft), shard (band, segment) is handled by worker (band + segment) % n_workers
+    a fragment belongs to every shard that its ranges cover, padded by a halo:
+        - x: the padded x range of MergeCandidateIndex.bounds. Two fragments pass the x test of merge_cost only if
+          these ranges intersect: the halo is the vehicle length, a fragment goes to a second worker only if it
+          crosses a segment border
+        - y: the y range padded by sqrt(8*thresh*wmax) on both sides. MergeCandidateIndex skips a pair whose y gap g
+          has 0.0625*g^2 > thresh*(wmax1+wmax2)/2, and sqrt(8*thresh*wmax1) + sqrt(8*thresh*wmax2) >= sqrt(8*thresh*(wmax1+wmax2))
+          this halo is about a lane wide at thresh 3 (wmax 6 ft), so bands narrower than a few lanes send most fragments
+          to several workers. band_width <= 0 keeps a single band, i.e., shards are x segments only
+    so the padded ranges of every pair that can be merged share a point, and the pair shares a worker
+    bounds: MergeCandidateIndex.bounds of the fragment. Unknown (nan) ranges go to all the workers
+    return a sorted list of worker indices
+    '''
+    _, _, sx, ex, ymin, ymax, wmax = bounds
+    if band_width > 0:
+        halo = math.sqrt(8 * thresh * wmax) if thresh > 0 else 0.0 # nan if wmax is nan
+        axes = [(ymin - halo, ymax + halo, band_width), (sx, ex, segment_length)]
+    else:
+        axes = [(0.0, 0.0, 1.0), (sx, ex, segment_length)]
+    ranges = []
+    for lo, hi, size in axes:
+        if math.isnan(lo) or math.isnan(hi):
+            return list(range(n_workers))
+        c0, c1 = math.floor(lo/size), math.floor(hi/size)
+        ranges.append(range(c0, min(c1, c0 + n_workers - 1) + 1)) # n_workers consecutive cells cover every worker
+    return sorted({(band + segment) % n_workers for band in ranges[0] for segment in ranges[1]})
@@ -1,10 +1,10 @@
-import pandas as pd
 import numpy as np
 from cvxopt import matrix, solvers, sparse,spdiag,spmatrix
 from bson.objectid import ObjectId
 from collections import defaultdict
 import os
 from i24_logger.log_writer import logger, catch_critical, log_warnings, log_errors
+from utils.utils_resample import resample_fragments
 # from .misc import flattenList
 
 # TODO
@@ -122,53 +122,12 @@ def resample(car, dt=0.04, fillnan=False):
     leave empty slop as nan
     '''
 
-    # Select time series only
-    time_series_field = ["timestamp", "x_position", "y_position"]
-    data = {key: car[key] for key in time_series_field}
-    
-    # Read to dataframe and resample
-    df = pd.DataFrame(data, columns=data.keys()) 
-    index = pd.to_timedelta(df["timestamp"], unit='s')
-    df = df.set_index(index)
-    df = df.drop(columns = "timestamp")
-    
-    freq = str(dt)+"S"
-#     df = df.resample(freq).mean() # leave nans
-#     if fillnan:
-#         df = df.interpolate(method='linear')
-#     df.index = df.index.values.astype('datetime64[ns]').astype('int64')*1e-9
-
-    # resample to 25hz
-    # df=df.groupby(df.index.floor('0.04S')).mean().resample('0.04S').asfreq()
-    # df.index = df.index.values.astype('datetime64[ns]').astype('int64')*1e-9
-    # df = df.interpolate(method='linear')
-    # df=df.groupby(df.index.floor('0.04S')).mean().resample('0.04S').asfreq() # resample to 25Hz snaps to the closest integer
-    
-    
-    
-    
-    # resample to 100hz
-    # to avoid the bias introduced by "floor" resample..., first upsample to 10ms, and then downsample to 25hz,
-    # this method does not "snap" the timestamps to floor
-    df=df.resample('10L').mean().interpolate(method="linear").resample(freq).asfreq()
-    df.index = df.index.values.astype('datetime64[ns]').astype('int64')*1e-9
-    # df=df.groupby(df.index.floor('0.04S')).mean().resample('0.04S').asfreq()
-
-
-
-    
-    
-    
+    # resample to 25hz (numpy kernel, same output as the pandas chain)
+    # df.resample('10L').mean().interpolate(method="linear").resample(freq).asfreq()
+    # first upsample to 10ms, and then downsample, this method does not "snap" the timestamps to floor
     # do not extrapolate for more than 1 sec
-    first_valid_time = pd.Series.first_valid_index(df['x_position'])
-    last_valid_time = pd.Series.last_valid_index(df['x_position'])
-    first_time = max(min(car['timestamp']), first_valid_time-1)
-    last_time = min(max(car['timestamp']), last_valid_time+1)
-    df=df[first_time:last_time]
-    
-    car['x_position'] = df['x_position'].values
-    car['y_position'] = df['y_position'].values
-    car['timestamp'] = df.index.values
+    resampled = resample_fragments([car], ["x_position", "y_position"], dt=dt, extrapolate=1)[0]
+    car.update(resampled)
         
     return car
 
@@ -9,7 +9,6 @@ import numpy as np
 # from scipy import stats
 from i24_logger.log_writer import catch_critical
 from utils.misc import calc_fit_select, calc_fit_select_ransac
-import statsmodels.api as sm
 import warnings
 warnings.filterwarnings('error')
 
@@ -33,12 +32,27 @@ def bhattacharyya_distance(mu1, mu2, cov1, cov2):
         return dist
     
 
+def bhattacharyya_distance_diag(mu1, mu2, var1, var2):
+    '''
+    bhattacharyya_distance for diagonal covariances cov1 = diag(var1), cov2 = diag(var2), on the variance vectors:
+        0.125 * sum(mu^2 / var) + 0.5 * sum(log(var) - 0.5*log(var1) - 0.5*log(var2)), var = (var1+var2)/2
+    O(n) instead of the inverse and determinants of 2n x 2n matrices. The log-determinants are sums of logs,
+    they do not under- or overflow, and the result is finite for finite positive variances
+    '''
+    mu = mu1 - mu2
+    var = (var1 + var2)/2
+    return 0.125 * np.sum(mu**2 / var) + 0.5 * np.sum(np.log(var) - 0.5*(np.log(var1) + np.log(var2)))
+    
+
 def bhattacharyya_coeff(bhatt_dist):
     return np.exp(-bhatt_dist)
 
 def weighted_least_squares(t,x,y,weights=None):
     '''
+    reference implementation (statsmodels WLS) of weighted_linear_fit, only used by the parity check in __main__
+    statsmodels is imported here so that the stitcher does not need it
     '''
+    import statsmodels.api as sm
     t = sm.add_constant(t)
     modelx = sm.WLS(x, t, weights=weights)
     resx = modelx.fit()
@@ -48,126 +62,108 @@ def weighted_least_squares(t,x,y,weights=None):
     fity = [resy.params[1],resy.params[0]]
     return fitx, fity
 
+def weighted_linear_fit(t, x, y, weights):
+    '''
+    closed-form weighted least squares of x and y against t, the same lines as weighted_least_squares
+    return (t0, t_mean, x_mean, y_mean, slope_x, slope_y, var_y): the lines pass through the weighted means,
+    x = x_mean + slope_x * (t - t0 - t_mean). Times are offset by t0 = t[0] to keep the precision of the mean
+    var_y is the variance of y (np.var), the measurement variance of these samples
+    '''
+    w = weights / np.sum(weights)
+    t0 = t[0]
+    t = t - t0
+    tm, xm, ym = np.dot(w, t), np.dot(w, x), np.dot(w, y)
+    d = t - tm
+    stt = np.dot(w, d*d)
+    if stt > 0:
+        slopex = np.dot(w, d*(x-xm)) / stt
+        slopey = np.dot(w, d*(y-ym)) / stt
+    else: # a single timestamp
+        slopex = slopey = 0.0
+    return t0, tm, xm, ym, slopex, slopey, np.var(y)
+
+
+def motion_ends(track):
+    '''
+    head and tail of a fragment for stitch_cost: its first and last ~1 sec of samples, and their fits
+    (weights towards the start of the fragment for the head, towards the end for the tail)
+    return {"head": (t, x, y, fit), "tail": (t, x, y, fit)}, fit from weighted_linear_fit
+    '''
+    t = np.asarray(track["timestamp"], dtype=np.float64)
+    x = np.asarray(track["x_position"], dtype=np.float64)
+    y = np.asarray(track["y_position"], dtype=np.float64)
+    n = min(len(t), int(1/dt))
+    ends = {}
+    for end, sl, weights in [("head", slice(None, n), np.linspace(1, 1e-6, n)), 
+                             ("tail", slice(len(t)-n, None), np.linspace(1e-6, 1, n))]:
+        ends[end] = (t[sl], x[sl], y[sl], weighted_linear_fit(t[sl], x[sl], y[sl], weights))
+    return ends
+
+
 @catch_critical(errors = (Exception))
-def stitch_cost(track1, track2, TIME_WIN, param):
+def stitch_cost(track1, track2, TIME_WIN, param, ends1=None, ends2=None):
     '''
     use bhattacharyya_distance
     track t,x,y must not have nans!
+    the fit of the longer track (its tail for track1, its head for track2) predicts the other one at its measured samples
+    ends1, ends2: motion_ends of the tracks, computed here if not given. MOTGraphSingle keeps them for the fragments in the
+    graph, the cost of a pair is then a few vector operations on 25 samples
     '''
     # print("compare ",track1["_id"], track2["_id"])
     t1 = track1["timestamp"] #[filter1]
     t2 = track2["timestamp"] #[filter2]
     
-    # offset timestamps to avoid large numbers in weighted least squares fit
-    toffset = min(t1[0], t2[0])
-    t1 = t1-toffset
-    t2 = t2-toffset
-    
     gap = t2[0] - t1[-1] 
     if gap < 0 or gap > TIME_WIN:
         return 1e6
     
-    x1 = track1["x_position"]#[filter1]
-    x2 = track2["x_position"]#[filter2]
-    
-    y1 = track1["y_position"]#[filter1]
-    y2 = track2["y_position"]#[filter2]
-
-    n1 = min(len(t1), int(1/dt)) # for track1
-    n2 = min(len(t2), int(1/dt)) # for track2
+    if ends1 is None:
+        ends1 = motion_ends(track1)
+    if ends2 is None:
+        ends2 = motion_ends(track2)
         
     if len(t1) >= len(t2):
-        anchor = 1 # project forward in time
         direction = track1["direction"]
-        # find the new fit for anchor1 based on the last ~1 sec of data
-        t1 = t1[-n1:]
-        x1 = x1[-n1:]
-        y1 = y1[-n1:] # TODO: could run into the danger that the ends of a track has bad speed estimate
-        # fitx, fity = calc_fit_select_ransac(t1,x1,y1,residual_threshold_x, residual_threshold_y)
-        # fitx, fity = calc_fit_select(t1,x1,y1)
-        weights = np.linspace(1e-6, 1, len(t1)) # put more weights towards end
-        fitx, fity = weighted_least_squares(t1,x1,y1,weights)
-        
-        # get the first chunk of track2
-        meast = t2[:n2]
-        measx = x2[:n2]
-        measy = y2[:n2]
+        fit = ends1["tail"][3] # the fit on the last ~1 sec of track1, TODO: could run into the danger that the ends of a track has bad speed estimate
+        meast, measx, measy, measfit = ends2["head"] # get the first chunk of track2
         pt = t1[-1] # cone starts at the end of t1
-        y0 = y1[-1]
         dir = 1 # cone should open to the +1 direction in time (predict track1 to future)
         
-        
     else:
-        anchor = 2
         direction = track2["direction"]
-        # find the new fit for anchor2 based on the first ~1 sec of track2
-        t2 = t2[:n2]
-        x2 = x2[:n2]
-        y2 = y2[:n2]
-        
-        # fitx, fity = calc_fit_select_ransac(t2,x2,y2,residual_threshold_x, residual_threshold_y)
-        # fitx, fity = calc_fit_select(t2,x2,y2)
-        weights = np.linspace(1, 1e-6, len(t2)) # put more weights towards front
-        fitx, fity = weighted_least_squares(t2,x2,y2,weights)
-        
+        fit = ends2["head"][3] # the fit on the first ~1 sec of track2
+        meast, measx, measy, measfit = ends1["tail"] # get the last chunk of tarck1
         pt = t2[0]
-        y0 = y2[0]
-        # get the last chunk of tarck1
-        meast = t1[-n1:]
-        measx = x1[-n1:]
-        measy = y1[-n1:]
         dir = -1 # use the fit of track2 to "predict" back in time
   
     # find where to start the cone
-    try:
-        tdiff = (meast - pt) * dir # tdiff should be positive
-    except TypeError:
-        meast = np.array(meast)
-        tdiff = (meast - pt) * dir 
+    tdiff = (meast - pt) * dir # tdiff should be positive
         
-    # bound x-velocity to non-negative for each direction
-    slope, intercept = fitx
-    if slope * direction < 0:
-        slope = 0
-        if anchor==1:
-            intercept = sum(weights * x1)/sum(weights)
-        else:
-            intercept = sum(weights * x2)/sum(weights)
-    targetx = slope * meast + intercept
-    slope, intercept = fity
-    targety = slope * meast + intercept
-    # targety = 0 * meast + y0
-    # print(anchor, fitx, fity)
+    # bound x-velocity to non-negative for each direction, the line then goes through the weighted mean of x
+    t0, tm, xm, ym, slopex, slopey, _ = fit
+    offset = (meast - t0) - tm
+    targetx = (slopex if slopex * direction >= 0 else 0) * offset + xm
+    targety = slopey * offset + ym
     cx, mx, cy, my = param["cx"], param["mx"], param["cy"], param["my"]
 
-    # old
-    # sigmax = (0.1 + tdiff * 0.01) * fitx[0] # 0.1,0.1, sigma in unit ft
-    # sigmay = (1 + tdiff *0.1) * fity[0]
-    
-    # old rewrite
-    # sigmax = (cx + mx * tdiff) * fitx[0]
-    # sigmay = (cy + my * tdiff) * fity[0]
-    # sigmay = cy + my*tdiff
-    
     # new, can avoide bhatt_distance divided by zero
-    sigmax = cx + mx * tdiff * abs(fitx[0])
-    sigmay = cy + my * tdiff * abs(fity[0])  
+    sigmax = cx + mx * tdiff * abs(slopex)
+    sigmay = cy + my * tdiff * abs(slopey)  
 
     varx = sigmax**2
     vary_pred = sigmay**2
-    vary_meas = np.var(measy)
-    vary_meas = max(vary_meas, cy**2) # lower bound 
+    vary_meas = max(measfit[6], cy**2) # lower bound 
 
-    # vectorize!
+    # vectorize! the covariances are diagonal, only their variance vectors are built
     n = len(meast)
     mu1 = np.hstack([targetx, targety]) # 1x 2n
     mu2 = np.hstack([measx, measy]) # 1 x 2n
-    cov1 = np.diag(np.hstack([varx, vary_pred])) # 2n x 2n
-    cov2 = np.diag(np.hstack([np.ones(n)*varx[0], np.ones(n)*vary_meas])) 
+    var1 = np.hstack([varx, vary_pred]) # diagonal of cov1, 2n
+    var2 = np.hstack([np.ones(n)*varx[0], np.ones(n)*vary_meas]) 
     
 
     try:
-        bd = bhattacharyya_distance(mu1, mu2, cov1, cov2)
+        bd = bhattacharyya_distance_diag(mu1, mu2, var1, var2)
         nll = bd/n # mean
     except Exception as e:
         print("{} in stitch_cost for {} and {}, assigned cost=10e6".format(str(e), track1["_id"], track2["_id"]))
@@ -189,6 +185,72 @@ def stitch_cost(track1, track2, TIME_WIN, param):
 
 
 
+@catch_critical(errors = (Exception))
+def stitch_cost_batch(tracks1, track2, TIME_WIN, param, ends1=None, ends2=None):
+    '''
+    stitch_cost(track1, track2) for every track1 in tracks1 in one vectorized pass, return an array of costs
+    ends1: list of motion_ends of tracks1, ends2: motion_ends of track2, computed here if not given
+    the measured and fitted windows of all pairs are stacked in (pairs, 1/dt) arrays, shorter windows are masked
+    pairs that stitch_cost cannot score (a gap out of [0, TIME_WIN], nans in the windows) cost 1e6
+    '''
+    costs = np.full(len(tracks1), 1e6)
+    t2 = track2["timestamp"]
+    gap = np.array([t2[0] - track1["timestamp"][-1] for track1 in tracks1], dtype=np.float64)
+    valid = np.flatnonzero(~((gap < 0) | (gap > TIME_WIN)))
+    if not len(valid):
+        return costs
+    if ends1 is None:
+        ends1 = [motion_ends(track1) for track1 in tracks1]
+    if ends2 is None:
+        ends2 = motion_ends(track2)
+    
+    # the fit of the longer track predicts the other one, as in stitch_cost
+    P, N = len(valid), int(1/dt)
+    meast, measx, measy = np.empty((P, N)), np.zeros((P, N)), np.zeros((P, N))
+    mask = np.zeros((P, N), dtype=bool)
+    fits = np.empty((P, 7))
+    vary_meas = np.empty(P)
+    pt, dir, direction = np.empty(P), np.empty(P), np.empty(P)
+    for row, i in enumerate(valid):
+        track1 = tracks1[i]
+        if len(track1["timestamp"]) >= len(t2):
+            fits[row] = ends1[i]["tail"][3]
+            t, x, y, measfit = ends2["head"]
+            pt[row], dir[row], direction[row] = track1["timestamp"][-1], 1, track1["direction"]
+        else:
+            fits[row] = ends2["head"][3]
+            t, x, y, measfit = ends1[i]["tail"]
+            pt[row], dir[row], direction[row] = t2[0], -1, track2["direction"]
+        n = len(t)
+        meast[row, :n], measx[row, :n], measy[row, :n] = t, x, y
+        meast[row, n:] = pt[row] # padding, masked out
+        mask[row, :n] = True
+        vary_meas[row] = measfit[6]
+    
+    t0, tm, xm, ym, slopex, slopey = (col[:, None] for col in fits.T[:6])
+    cx, mx, cy, my = param["cx"], param["mx"], param["cy"], param["my"]
+    with np.errstate(invalid="ignore", over="ignore", divide="ignore"): # nans give a nan cost, set to 1e6 below
+        tdiff = (meast - pt[:, None]) * dir[:, None]
+        offset = (meast - t0) - tm
+        targetx = np.where(slopex * direction[:, None] >= 0, slopex, 0) * offset + xm
+        targety = slopey * offset + ym
+        varx = (cx + mx * tdiff * np.abs(slopex))**2
+        vary_pred = (cy + my * tdiff * np.abs(slopey))**2
+        vary_meas = np.maximum(vary_meas, cy**2)[:, None] # lower bound
+        
+        # bhattacharyya_distance_diag of every pair, the x part has var2 = varx at the first sample
+        bd = 0
+        for mu, var1, var2 in [(targetx - measx, varx, varx[:, :1]), (targety - measy, vary_pred, vary_meas)]:
+            var = (var1 + var2)/2
+            terms = 0.125 * mu**2 / var + 0.5 * (np.log(var) - 0.5*(np.log(var1) + np.log(var2)))
+            bd = bd + np.sum(np.where(mask, terms, 0), axis=1)
+        cost = bd / mask.sum(axis=1) + 0.1 * gap[valid]
+    costs[valid] = np.where(np.isfinite(cost), cost, 1e6)
+    return costs
+
+
+
+
 @catch_critical(errors = (Exception))
 def stitch_cost_simple_distance(track1, track2, TIME_WIN, param):
     """
@@ -224,3 +286,115 @@ def stitch_cost_simple_distance(track1, track2, TIME_WIN, param):
 
 
 
+def stitch_cost_simple_distance_batch(tracks1, track2, TIME_WIN):
+    '''
+    stitch_cost_simple_distance(track1, track2) for every track1 in tracks1, return an array of distances
+    only the last position of each track1 and the first of track2 are read. Gaps out of [0, TIME_WIN] give 1e6
+    '''
+    t2 = track2["timestamp"]
+    gap = np.array([t2[0] - track1["timestamp"][-1] for track1 in tracks1], dtype=np.float64)
+    dx = np.array([track1["x_position"][-1] for track1 in tracks1], dtype=np.float64) - track2["x_position"][0]
+    dy = np.array([track1["y_position"][-1] for track1 in tracks1], dtype=np.float64) - track2["y_position"][0]
+    with np.errstate(invalid="ignore"):
+        distance = np.sqrt(dx**2 + dy**2)
+    distance[(gap < 0) | (gap > TIME_WIN)] = 1e6
+    return distance
+
+
+
+if __name__ == '__main__':
+    # bhattacharyya_distance_diag against the dense bhattacharyya_distance, on stitch_cost-like variances (n up to 25)
+    import time
+    rng = np.random.default_rng(0)
+    max_diff, n_pairs, n_dense_fail = 0, 0, 0
+    t_dense = t_diag = 0
+    for _ in range(2000):
+        n = int(rng.integers(2, 26))
+        tdiff = np.sort(rng.uniform(0, 20, n)) # up to time_win
+        var1 = np.hstack([(0.2 + 0.1*tdiff*rng.uniform(0, 100))**2, (2 + 0.1*tdiff*rng.uniform(0, 1))**2])
+        var2 = np.hstack([np.ones(n)*var1[0], np.ones(n)*max(rng.uniform(0, 10), 4)])
+        mu1, mu2 = rng.normal(0, 10, 2*n), rng.normal(0, 10, 2*n)
+        t1 = time.time()
+        try:
+            dense = bhattacharyya_distance(mu1, mu2, np.diag(var1), np.diag(var2))
+        except Exception: # determinants out of range
+            dense = None
+        t2 = time.time()
+        diag = bhattacharyya_distance_diag(mu1, mu2, var1, var2)
+        t3 = time.time()
+        t_dense += t2-t1
+        t_diag += t3-t2
+        if dense is None:
+            n_dense_fail += 1
+            continue
+        max_diff = max(max_diff, abs(dense-diag)/max(1, abs(dense)))
+        n_pairs += 1
+    print("{} pairs, max relative difference {:.2e}, dense failed on {} pairs".format(n_pairs, max_diff, n_dense_fail))
+    print("dense: {:.3f} sec, diagonal: {:.3f} sec".format(t_dense, t_diag))
+    assert max_diff < 1e-9, "bhattacharyya_distance_diag differs from bhattacharyya_distance"
+    
+    # weighted_linear_fit against the statsmodels fit of weighted_least_squares, and stitch_cost with cached ends
+    param = {"cx": 0.2, "mx": 0.1, "cy": 2, "my": 0.1}
+    tracks = []
+    for j in range(300):
+        n = int(rng.integers(1, 200))
+        t = 1628080000 + rng.uniform(0, 60) + np.arange(n) * 0.04
+        tracks.append({"_id": j, "direction": 1, "timestamp": t, "x_position": 80*(t-1628080000) + rng.normal(0, 2, n),
+                       "y_position": 12 + rng.normal(0, 0.5, n)})
+    max_diff = 0
+    t_wls = t_fit = 0
+    for track in tracks:
+        t, x, y = track["timestamp"][-25:], track["x_position"][-25:], track["y_position"][-25:]
+        if len(t) < 2:
+            continue
+        weights = np.linspace(1e-6, 1, len(t))
+        t1 = time.time()
+        fitx, fity = weighted_least_squares(t - t[0], x, y, weights)
+        t2 = time.time()
+        t0, tm, xm, ym, slopex, slopey, _ = weighted_linear_fit(t, x, y, weights)
+        t3 = time.time()
+        t_wls += t2-t1
+        t_fit += t3-t2
+        max_diff = max(max_diff, np.max(np.abs(fitx[0]*(t-t[0]) + fitx[1] - (slopex*(t-t0-tm) + xm))),
+                       np.max(np.abs(fity[0]*(t-t[0]) + fity[1] - (slopey*(t-t0-tm) + ym))))
+    print("fits: max difference of the fitted lines {:.2e} ft, statsmodels: {:.3f} sec, closed form: {:.3f} sec".format(max_diff, t_wls, t_fit))
+    assert max_diff < 1e-6, "weighted_linear_fit differs from weighted_least_squares"
+    
+    tracks.sort(key=lambda track: track["timestamp"][-1])
+    ends = [motion_ends(track) for track in tracks]
+    t1 = time.time()
+    costs = [stitch_cost(a, b, 20, param) for a in tracks[:100] for b in tracks[:100]]
+    t2 = time.time()
+    cached = [stitch_cost(a, b, 20, param, ea, eb) for a, ea in zip(tracks[:100], ends[:100]) for b, eb in zip(tracks[:100], ends[:100])]
+    t3 = time.time()
+    print("stitch_cost on {} pairs: {:.3f} sec, with cached ends: {:.3f} sec, same costs: {}".format(
+        len(costs), t2-t1, t3-t2, costs == cached))
+    assert costs == cached, "stitch_cost differs with cached ends"
+    
+    # stitch_cost_batch against stitch_cost, the new fragment against all the earlier ones as in MOTGraphSingle.add_node
+    max_diff, flips, n_pairs = 0, 0, 0
+    t_pair = t_batch = 0
+    for k in range(100, 300):
+        track2, earlier = tracks[k], tracks[k-100:k]
+        t1 = time.time()
+        pair = np.array([stitch_cost(a, track2, 20, param, ea, ends[k]) for a, ea in zip(earlier, ends[k-100:k])])
+        t2 = time.time()
+        batch = stitch_cost_batch(earlier, track2, 20, param, ends[k-100:k], ends[k])
+        t3 = time.time()
+        t_pair += t2-t1
+        t_batch += t3-t2
+        max_diff = max(max_diff, np.max(np.abs(pair-batch)/np.maximum(1, np.abs(pair))))
+        flips += np.count_nonzero((pair <= 3) != (batch <= 3))
+        n_pairs += np.count_nonzero(pair < 1e6)
+    print("{} scored pairs, max relative difference {:.2e}, {} decisions flipped at thresh 3".format(n_pairs, max_diff, flips))
+    print("stitch_cost: {:.3f} sec, stitch_cost_batch: {:.3f} sec".format(t_pair, t_batch))
+    assert flips == 0 and max_diff < 1e-9, "stitch_cost_batch differs from stitch_cost"
+    
+    # stitch_cost_simple_distance_batch against stitch_cost_simple_distance
+    max_diff = 0
+    for k in range(100, 300):
+        pair = np.array([stitch_cost_simple_distance(a, tracks[k], 20, param) for a in tracks[k-100:k]])
+        batch = stitch_cost_simple_distance_batch(tracks[k-100:k], tracks[k], 20)
+        max_diff = max(max_diff, np.max(np.abs(pair-batch)/np.maximum(1, np.abs(pair))))
+    print("simple distance: max relative difference {:.2e}".format(max_diff))
+    assert max_diff < 1e-9, "stitch_cost_simple_distance_batch differs from stitch_cost_simple_distance"
@@ -0,0 +1,144 @@
+'''
+Columnar fragment store
+A raw <raw_collection>.json dump is converted once into a directory of
+- <field>.f64: one contiguous float64 array per time-series field (all fragments concatenated)
+- offsets.npy: fragment i lives in [offsets[i], offsets[i+1]) of every field array
+- meta.json: field names and the non time-series part of every fragment (_id, direction, vehicle class...)
+- index.npy: per-fragment scalars (time range, direction, compute_node_id as in the raw data) to select fragments without reading them
+Fragments are served back as numpy views of the memory-mapped field arrays, so a rerun never parses json again.
+
+usage: python -m utils.utils_store <raw_collection>
+'''
+import os
+import json
+import ijson
+import numpy as np
+
+from utils.misc import prepare_raw_doc, RAW_TIME_SERIES_FIELDS
+
+
+INDEX_DTYPE = [("first_timestamp", "f8"), ("last_timestamp", "f8"), ("direction", "i8"), ("compute_node_id", "i8")]
+
+
+def store_path(raw_collection):
+    return raw_collection + "_store"
+
+
+def write_fragment_store(json_path, path):
+    '''
+    stream json_path (a json array of raw fragments) into a columnar store at path
+    fragments are kept in file order. tracks shorter than 4 samples are discarded (same as static_data_reader)
+    return the number of fragments written and discarded
+    '''
+    os.makedirs(path, exist_ok=True)
+    offsets = [0]
+    docs = []
+    index = []
+    discard = 0
+
+    field_files = {field: open(os.path.join(path, field + ".f64"), "wb") for field in RAW_TIME_SERIES_FIELDS}
+    try:
+        with open(json_path, 'rb') as f:
+            for doc in ijson.items(f, 'item'):
+                if len(doc["timestamp"]) <= 3:
+                    discard += 1
+                    continue
+
+                # index the raw compute_node_id, prepare_raw_doc overwrites it
+                try:
+                    node = int(doc["compute_node_id"])
+                except (KeyError, TypeError, ValueError):
+                    node = -1
+                doc = prepare_raw_doc(doc)
+                if doc is None:
+                    discard += 1
+                    continue
+                index.append((doc["first_timestamp"], doc["last_timestamp"], int(doc["direction"]), node))
+                n = len(doc["timestamp"])
+                for field in RAW_TIME_SERIES_FIELDS:
+                    arr = np.asarray(doc.pop(field), dtype=np.float64)
+                    if len(arr) != n: # keep every field aligned with timestamp
+                        arr = np.concatenate([arr[:n], np.full(max(0, n-len(arr)), np.nan)])
+                    field_files[field].write(arr.tobytes())
+                offsets.append(offsets[-1] + n)
+                docs.append(doc)
+    finally:
+        for fh in field_files.values():
+            fh.close()
+
+    np.save(os.path.join(path, "offsets.npy"), np.array(offsets, dtype=np.int64))
+    np.save(os.path.join(path, "index.npy"), np.array(index, dtype=INDEX_DTYPE))
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({"fields": RAW_TIME_SERIES_FIELDS, "docs": docs}, f, default=float)
+
+    return len(docs), discard
+
+
+
+class FragmentStore:
+    '''
+    read-only access to a store written by write_fragment_store
+    time-series fields are numpy views into memory-mapped arrays (no copy, no parsing)
+    '''
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        self.fields = meta["fields"]
+        self.docs = meta["docs"]
+        self.offsets = np.load(os.path.join(path, "offsets.npy"))
+        self.index = np.load(os.path.join(path, "index.npy"))
+        self.columns = {}
+        for field in self.fields:
+            filename = os.path.join(path, field + ".f64")
+            if os.path.getsize(filename) > 0:
+                self.columns[field] = np.memmap(filename, dtype=np.float64, mode="r")
+            else:
+                self.columns[field] = np.zeros(0)
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __getitem__(self, i):
+        s, e = self.offsets[i], self.offsets[i+1]
+        doc = dict(self.docs[i])
+        for field in self.fields:
+            doc[field] = self.columns[field][s:e].view(np.ndarray)
+        return doc
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+            
+    def select(self, query_filter):
+        '''
+        indices of the fragments that pass query_filter (see data_feed.fragment_filter for the keys)
+        evaluated on the index and the memory-mapped columns only, no fragment is materialized
+        '''
+        keep = np.ones(len(self), dtype=bool)
+        if not query_filter:
+            return np.flatnonzero(keep)
+        
+        if "start_time" in query_filter:
+            keep &= self.index["last_timestamp"] >= query_filter["start_time"]
+        if "end_time" in query_filter:
+            keep &= self.index["first_timestamp"] <= query_filter["end_time"]
+        if "direction" in query_filter:
+            keep &= np.isin(self.index["direction"], query_filter["direction"])
+        if "compute_node_id" in query_filter:
+            keep &= np.isin(self.index["compute_node_id"], query_filter["compute_node_id"])
+        if "min_length" in query_filter:
+            keep &= np.diff(self.offsets) >= query_filter["min_length"]
+        if "min_conf" in query_filter and len(self) > 0:
+            highconf = (self.columns["detection_confidence"] >= query_filter["min_conf"]).astype(np.int64)
+            num_highconf = np.diff(np.concatenate([[0], np.cumsum(highconf)])[self.offsets])
+            keep &= num_highconf >= 4
+            
+        return np.flatnonzero(keep)
+
+
+
+if __name__ == '__main__':
+    import sys
+    raw_collection = sys.argv[1]
+    n, discard = write_fragment_store(raw_collection + ".json", store_path(raw_collection))
+    print("Wrote {} fragments to {}, discarded {} short tracks".format(n, store_path(raw_collection), discard))
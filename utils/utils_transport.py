@@ -0,0 +1,358 @@
+'''
+Message transport between pipeline stages
+- Batch: a list of messages sent as a single queue item, to amortize the queue (manager) round-trip and pickling per fragment
+- BatchedQueueWriter / BatchedQueueReader: put and get single messages, exchange Batches under the hood
+- EndOfStream: sent by a writer after its last message (close()), so that the reader stops as soon as all its producers are done
+- share_arrays / attach_arrays / release_arrays: move the time-series arrays of a fragment through a shared memory segment,
+  only a small handle goes through the queue
+- RingQueue: single-producer single-consumer queue on a shared ring buffer, and make_queue to pick the queue of an edge
+
+Shared memory life cycle: the sender copies the arrays into a new segment (share_arrays). A receiver either
+    - attach_arrays(doc): numpy views of the segment, and release_arrays(doc) when done. This closes and unlinks the segment, or
+    - attach_arrays(doc, copy=True): private copies, the segment stays alive and doc keeps the handle, so that the
+      same segment is forwarded downstream without another copy. The last receiver releases it.
+'''
+import queue
+import time
+import pickle
+import ctypes
+import platform
+import multiprocessing as mp
+from collections import deque
+from multiprocessing import shared_memory
+import numpy as np
+
+from utils.misc import RAW_TIME_SERIES_FIELDS
+
+X86_MACHINES = ("x86_64", "AMD64", "i386", "i686") # platform.machine() of the machines RingQueue is safe on
+SHM_KEY = "_shm" # handle of a shared segment in a fragment dict: (name, {field: (offset, length)})
+_attached = {} # segments mapped by this process, key: name, val: SharedMemory
+
+
+class Batch(list):
+    '''
+    a micro-batch of messages. A stage may send lists as messages themselves (e.g., a stitched path),
+    a subclass keeps the two apart
+    '''
+    pass
+
+
+
+class EndOfStream(queue.Empty):
+    '''
+    end-of-stream marker. Put to a queue by BatchedQueueWriter.close(), and raised by BatchedQueueReader.get()
+    once every producer of that queue has closed. It is a queue.Empty so that a stage flushes and exits
+    the same way as on a get timeout, which is left as a fallback for a producer that died without closing
+    closes are counted, not matched to producers: a stage only closes its output once its own input is closed. On an
+    error or a get timeout it flushes and leaves the queue open, pp_lite may restart it to write to the same queue
+    '''
+    pass
+
+
+
+class BatchedQueueWriter:
+    '''
+    buffer messages and put them to q as one Batch
+    a batch is sent when it has batch_size messages, or when the oldest buffered message is older than flush_interval (sec)
+    call flush() before the stage blocks, and close() when it exits
+    shm=True: the arrays of a message (a fragment dict, or a list of them) are moved to shared memory, see share_arrays
+    '''
+    def __init__(self, q, batch_size=1, flush_interval=0, shm=False):
+        self.q = q
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.shm = shm
+        self.buffer = []
+        self.oldest = None
+
+    def put(self, item):
+        if self.shm:
+            item = [share_arrays(doc) for doc in item] if isinstance(item, list) else share_arrays(item)
+        if not self.buffer:
+            self.oldest = time.time()
+        self.buffer.append(item)
+        if len(self.buffer) >= self.batch_size or time.time() - self.oldest >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.q.put(Batch(self.buffer))
+            self.buffer = []
+            
+    def close(self):
+        self.flush()
+        self.q.put(EndOfStream())
+
+    def qsize(self):
+        return self.q.qsize()
+
+
+
+class BatchedQueueReader:
+    '''
+    get single messages from q, whether they were sent one by one or in a Batch
+    on_idle is called every idle_interval sec while waiting for q, e.g., to flush the writer of this stage
+    n_producers: number of writers that close q, EndOfStream is raised after the last one
+    '''
+    def __init__(self, q, on_idle=None, idle_interval=None, n_producers=1):
+        self.q = q
+        self.on_idle = on_idle
+        self.idle_interval = idle_interval
+        self.n_producers = n_producers
+        self.closed = 0
+        self.buffer = deque()
+
+    def get(self, timeout=None):
+        '''
+        same as queue.get(timeout=timeout), raise queue.Empty if no message comes within timeout,
+        and EndOfStream once all producers have closed
+        '''
+        if self.buffer:
+            return self.buffer.popleft()
+        if self.closed >= self.n_producers:
+            raise EndOfStream()
+
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            if deadline is None:
+                wait = self.idle_interval
+            elif self.idle_interval is None:
+                wait = max(0, deadline - time.time())
+            else:
+                wait = min(self.idle_interval, max(0, deadline - time.time()))
+            try:
+                msg = self.q.get(timeout=wait)
+            except queue.Empty:
+                if self.on_idle:
+                    self.on_idle()
+                if deadline is not None and time.time() >= deadline:
+                    raise
+                continue
+
+            if isinstance(msg, EndOfStream):
+                self.closed += 1
+                if self.closed >= self.n_producers:
+                    raise msg
+                continue
+            if isinstance(msg, Batch):
+                self.buffer.extend(msg)
+                if not self.buffer: # empty batch
+                    continue
+                return self.buffer.popleft()
+            return msg
+
+    def empty(self):
+        return not self.buffer and self.q.empty()
+
+
+
+def share_arrays(doc, fields=RAW_TIME_SERIES_FIELDS):
+    '''
+    return a shallow copy of doc where the array fields are replaced by a handle to a shared memory segment
+    if doc already carries a handle (it was attached with copy=True), that segment is forwarded as is
+    '''
+    if not isinstance(doc, dict):
+        return doc
+    
+    # the fields are kept as None placeholders so that attach_arrays restores the key order
+    shared = dict(doc)
+    if SHM_KEY in doc:
+        for field in doc[SHM_KEY][1]:
+            shared[field] = None
+        return shared
+    
+    arrays = {}
+    for field in fields:
+        val = doc.get(field)
+        if isinstance(val, (list, np.ndarray)) and len(val) > 0:
+            arrays[field] = np.asarray(val, dtype=np.float64)
+    if not arrays:
+        return shared
+    
+    size = sum(arr.nbytes for arr in arrays.values())
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    layout = {}
+    offset = 0
+    for field, arr in arrays.items():
+        np.ndarray(len(arr), dtype=np.float64, buffer=shm.buf, offset=offset)[:] = arr
+        layout[field] = (offset, len(arr))
+        offset += arr.nbytes
+        shared[field] = None
+    shm.close()
+    
+    shared[SHM_KEY] = (shm.name, layout)
+    return shared
+
+
+def attach_arrays(doc, copy=False):
+    '''
+    put the arrays of a shared doc back in place, in place
+    copy=False: numpy views of the segment, call release_arrays(doc) once they are not needed
+    copy=True: private arrays. The segment is unmapped right away but kept alive for forwarding
+    '''
+    if not isinstance(doc, dict) or SHM_KEY not in doc:
+        return doc
+    
+    name, layout = doc[SHM_KEY]
+    shm = shared_memory.SharedMemory(name=name)
+    for field, (offset, n) in layout.items():
+        view = np.ndarray(n, dtype=np.float64, buffer=shm.buf, offset=offset)
+        doc[field] = np.array(view) if copy else view
+        
+    if copy:
+        del view
+        shm.close()
+    else:
+        _attached[name] = shm
+        
+    return doc
+
+
+def release_arrays(doc, copy=True):
+    '''
+    close and unlink the segment of a shared doc, this is the last receiver
+    copy=True: arrays that are still views of the segment are replaced by private copies
+    copy=False: they are dropped from doc
+    '''
+    if not isinstance(doc, dict) or SHM_KEY not in doc:
+        return doc
+    
+    name, layout = doc.pop(SHM_KEY)
+    shm = _attached.pop(name, None)
+    if shm is None: # attached with copy=True, or not attached at all
+        shm = shared_memory.SharedMemory(name=name)
+    else:
+        for field in layout:
+            val = doc.get(field)
+            if isinstance(val, np.ndarray) and np.shares_memory(val, np.frombuffer(shm.buf, dtype=np.uint8)):
+                if copy:
+                    doc[field] = np.array(val)
+                else:
+                    doc.pop(field)
+        val = None
+    
+    shm.close()
+    shm.unlink()
+    return doc
+
+
+
+class RingQueue:
+    '''
+    single-producer single-consumer queue on a shared memory ring buffer. No lock and no server process:
+    tail (bytes written) is only advanced by the producer, head (bytes read) only by the consumer
+    messages are pickled and stored with an 8-byte length prefix, and may wrap around the end of the buffer
+    put waits while the ring is full, get polls while it is empty, with a short backoff sleep
+    the counters are published after the payload is written, with no barrier: this relies on stores not being reordered,
+    only true on x86. make_queue raises for "ring" on other machines
+    exactly one process may put and one process may get at a time, use multiprocessing.Queue for fan-in edges
+    '''
+    MIN_WAIT = 5e-5
+    MAX_WAIT = 5e-3
+    
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buf = mp.RawArray(ctypes.c_ubyte, capacity)
+        self.head = mp.RawValue(ctypes.c_uint64, 0)
+        self.tail = mp.RawValue(ctypes.c_uint64, 0)
+        self.n_put = mp.RawValue(ctypes.c_uint64, 0)
+        self.n_get = mp.RawValue(ctypes.c_uint64, 0)
+        self._view = None
+        
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_view"] = None # memoryviews cannot be pickled, rebuilt in the child process
+        return state
+    
+    @property
+    def view(self):
+        if self._view is None:
+            self._view = memoryview(self.buf).cast("B")
+        return self._view
+    
+    def _wait(self, ready, timeout, exception):
+        deadline = None if timeout is None else time.time() + timeout
+        wait = self.MIN_WAIT
+        while not ready():
+            if deadline is not None and time.time() >= deadline:
+                raise exception
+            time.sleep(wait)
+            wait = min(2*wait, self.MAX_WAIT)
+    
+    def _write(self, pos, data):
+        i = pos % self.capacity
+        first = min(len(data), self.capacity - i)
+        self.view[i:i+first] = data[:first]
+        if first < len(data):
+            self.view[:len(data)-first] = data[first:]
+    
+    def _read(self, pos, n):
+        i = pos % self.capacity
+        first = min(n, self.capacity - i)
+        data = bytes(self.view[i:i+first])
+        if first < n:
+            data += bytes(self.view[:n-first])
+        return data
+    
+    def put(self, item, block=True, timeout=None):
+        data = pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL)
+        msg = len(data).to_bytes(8, "little") + data
+        if len(msg) > self.capacity:
+            raise ValueError("Message of {} bytes exceeds the ring capacity {}. Increase ring_capacity".format(len(msg), self.capacity))
+        tail = self.tail.value
+        self._wait(lambda: self.capacity - (tail - self.head.value) >= len(msg), timeout if block else 0, queue.Full)
+        self._write(tail, msg)
+        self.tail.value = tail + len(msg)
+        self.n_put.value += 1
+        
+    def get(self, block=True, timeout=None):
+        head = self.head.value
+        self._wait(lambda: self.tail.value != head, timeout if block else 0, queue.Empty)
+        n = int.from_bytes(self._read(head, 8), "little")
+        item = pickle.loads(self._read(head+8, n))
+        self.head.value = head + 8 + n
+        self.n_get.value += 1
+        return item
+    
+    def put_nowait(self, item):
+        return self.put(item, block=False)
+    
+    def get_nowait(self):
+        return self.get(block=False)
+    
+    def qsize(self):
+        return self.n_put.value - self.n_get.value
+    
+    def empty(self):
+        return self.head.value == self.tail.value
+    
+    
+    
+def make_queue(parameters, mp_manager, fan_in=False):
+    '''
+    the queue of one edge of the stage graph, selected by parameters["queue_transport"]
+    - "manager": a queue proxy served by mp_manager, every operation is a round-trip to the manager process
+    - "mp": multiprocessing.Queue
+    - "ring": RingQueue of parameters["ring_capacity"] bytes. fan_in edges (several producers) get a multiprocessing.Queue
+      x86 only, see RingQueue
+    multiprocessing.Queue and RingQueue are shared by inheritance only: pass them as Process args or Pool initargs
+    '''
+    transport = parameters["queue_transport"]
+    if transport == "manager":
+        return mp_manager.Queue()
+    if transport == "mp" or (transport == "ring" and fan_in):
+        return mp.Queue()
+    if transport == "ring":
+        if platform.machine() not in X86_MACHINES:
+            raise ValueError("queue_transport ring needs x86, use mp on {}".format(platform.machine()))
+        return RingQueue(parameters["ring_capacity"])
+    raise ValueError("Unknown queue_transport {}".format(transport))
+
+
+
+def batched_writer(q, parameters):
+    return BatchedQueueWriter(q, parameters["queue_batch_size"], parameters["queue_flush_interval"], parameters["shm_transport"])
+
+
+def batched_reader(q, parameters, on_idle=None, n_producers=1):
+    return BatchedQueueReader(q, on_idle, parameters["queue_flush_interval"] or None, n_producers)